@@ -0,0 +1,1001 @@
+import io
+import os
+import copy
+import sys
+import json
+import time
+import platform
+import random
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+import geometry_cache
+from state import Position, State, CompactState
+from strategy import Minimax, MotionOffense
+
+
+# [rect, x_offset, y_offset, factor]
+COURTS = {
+    "half_0.9": [[0, 0, 15, 14], 7.5, 12.425, 0.9],
+    "half_0.5": [[0, 0, 15, 14], 7.5, 12.425, 0.5],
+    "full_0.5": [[0, 0, 28, 15], 1.575, 7.5, 0.5],
+    "full_0.25": [[0, 0, 28, 15], 1.575, 7.5, 0.25],
+}
+
+
+def make_formation(n_agent=6, seed=0, court="half_0.9", state_class=State):
+    """
+    Seeded random formation: n_agent / 2 + 3 stand places with random
+    links (every place linked to the next one), offense on the first
+    stand places and defense on other random nodes.
+    """
+    rect, x_offset, y_offset, factor = COURTS[court]
+    state = state_class(rect, x_offset, y_offset, factor=factor, n_agent=n_agent)
+    rng = random.Random(seed)
+    nodes = list(state.position.virtual_pos)
+    rng.shuffle(nodes)
+    half = n_agent // 2
+    places = nodes[:half + 3]
+    links = []
+    for i in range(len(places)):
+        for j in range(i + 1, len(places)):
+            if rng.random() < 0.6:
+                links.append([places[i], places[j]])
+    for i in range(len(places)):
+        links.append([places[i], places[(i + 1) % len(places)]])
+    state.set_agents(places[:half], nodes[half + 3:half + 3 + half], links)
+    return state
+
+
+def timeit(func, repeat=3):
+    """best wall time of func() in seconds, and its last return value"""
+    best = None
+    ret = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, ret
+
+
+def legacy_lattice(position):
+    """the recursive list-backed lattice builder Position used to run"""
+    def dfs(x, y, pos):
+        for dx, dy in Position.lattice_moves:
+            if ([x + dx, y + dy] not in pos and
+                    position.virtual_is_in([x + dx, y + dy])):
+                pos.append([x + dx, y + dy])
+                dfs(x + dx, y + dy, pos)
+
+    pos = []
+    dfs(0, 0, pos)
+    return pos
+
+
+def bench_lattice(courts, repeat=3):
+    for name in courts:
+        rect, x_offset, y_offset, factor = COURTS[name]
+        position = Position(rect, x_offset, y_offset, factor, path_table=False)
+        t_new, _ = timeit(position.build_lattice, repeat)
+        try:
+            t_old, _ = timeit(lambda: legacy_lattice(position), repeat)
+            old = "{:9.2f} ms".format(t_old * 1000)
+        except RecursionError:
+            old = "RecursionError"
+        print("lattice {:10s} nodes {:6d}  new {:9.2f} ms  old {}".format(
+            name, position.n_node, t_new * 1000, old))
+
+
+def legacy_pick(position, real_pos):
+    """the linear scan State.real_to_close_virtual used to run"""
+    for vpos in position.virtual_pos:
+        rpos = position.virtual_to_real(vpos)
+        if pow(pow(real_pos[0] - rpos[0], 2) + pow(real_pos[1] - rpos[1], 2), 0.5) < 0.5:
+            return vpos
+    return None
+
+
+def bench_pick(courts, n_query=2000, repeat=3, seed=0):
+    """snapping random real positions to the lattice: linear scan vs nearest_nodes"""
+    rng = random.Random(seed)
+    for name in courts:
+        rect, x_offset, y_offset, factor = COURTS[name]
+        position = Position(rect, x_offset, y_offset, factor, path_table=False)
+        queries = [[rng.uniform(rect[0], rect[0] + rect[2]), rng.uniform(rect[1], rect[1] + rect[3])]
+                   for _ in range(n_query)]
+        t_new, nodes = timeit(lambda: position.nearest_nodes(queries, 0.5), repeat)
+        n_old = max(1, min(n_query, 200000 // position.n_node))
+        t_old, _ = timeit(lambda: [legacy_pick(position, q) for q in queries[:n_old]], 1)
+        for q, node in zip(queries, nodes):
+            if node is not None:
+                assert legacy_pick(position, q) is not None
+        print("pick {:10s} nodes {:6d}  queries/s new {:10.0f}  old {:10.0f}".format(
+            name, position.n_node, n_query / t_new, n_old / t_old))
+
+
+def bench_startup(courts, repeat=3):
+    """Position with path table: full build vs load from the geometry cache"""
+    cache_dir = tempfile.mkdtemp(prefix="bench_geometry_")
+    for name in courts:
+        rect, x_offset, y_offset, factor = COURTS[name]
+        n_node = Position(rect, x_offset, y_offset, factor, path_table=False).n_node
+        if n_node > 2000:
+            print("startup {:10s} nodes {:6d}  skipped, path table too large".format(
+                name, n_node))
+            continue
+        t_build, _ = timeit(lambda: Position(rect, x_offset, y_offset, factor, path_table=True), 1)
+        Position(rect, x_offset, y_offset, factor, path_table=True, cache_dir=cache_dir)
+        t_load, _ = timeit(lambda: Position(rect, x_offset, y_offset, factor, path_table=True,
+                                            cache_dir=cache_dir), repeat)
+        print("startup {:10s} nodes {:6d}  build {:9.2f} ms  cached {:9.2f} ms".format(
+            name, n_node, t_build * 1000, t_load * 1000))
+    geometry_cache.clear(cache_dir)
+    os.rmdir(cache_dir)
+
+
+def bench_minimax(n_agents, depths, seeds=(0, 1, 2)):
+    """
+    full-width minimax against alpha-beta with transposition table, with
+    scalar and batched leaf evaluation
+    """
+    modes = {
+        "full": dict(alpha_beta=False),
+        "alpha_beta": dict(),
+        "batched": dict(batch_leaves=True),
+    }
+    for n_agent in n_agents:
+        for depth in depths:
+            line = "minimax n_agent {:2d} depth {}".format(n_agent, depth)
+            results = []
+            for name, kwargs in modes.items():
+                nodes = 0
+                elapsed = 0.
+                moves = []
+                for seed in seeds:
+                    state = make_formation(n_agent, seed)
+                    minimax = Minimax(**kwargs)
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        moves.append(minimax.next_move(0, state, depth))
+                    elapsed += time.perf_counter() - start
+                    nodes += minimax.node_count
+                results.append(moves)
+                line += "  {} {:8d} nodes {:8.3f} s".format(name, nodes, elapsed)
+            # every mode returns the move of the full-width search
+            assert all(moves == results[0] for moves in results), line
+            print(line)
+
+
+def bench_motion(n_agents, depths, seeds=(0, 1, 2), beam_width=4):
+    """MotionOffense.next_move: nodes expanded and time per search mode"""
+    modes = {
+        "plain": dict(transposition_size=0),
+        "cached": dict(),
+        "bounded": dict(search="bounded"),
+        "beam": dict(search="beam", beam_width=beam_width),
+    }
+    for n_agent in n_agents:
+        for depth in depths:
+            line = "motion n_agent {:2d} depth {}".format(n_agent, depth)
+            results = {}
+            for name, kwargs in modes.items():
+                elapsed = 0.
+                nodes = 0
+                results[name] = []
+                for seed in seeds:
+                    state = make_formation(n_agent, seed)
+                    offense = MotionOffense(0.2, 0.8, **kwargs)
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        results[name].append(offense.next_move(state, depth))
+                    elapsed += time.perf_counter() - start
+                    nodes += offense.node_count
+                line += "  {} {:6d} nodes {:7.3f} s".format(name, nodes, elapsed)
+            # beam is approximate, the exact modes return the same (move, log_p)
+            assert results["plain"] == results["cached"] == results["bounded"], line
+            print(line)
+
+
+def bench_movegen(n_agents, seeds=(0, 1, 2), repeat=3):
+    """moves/sec of get_step_1_moves + refine_possible_moves vs iter_moves"""
+    offense = MotionOffense(0.2, 0.8)
+    for n_agent in n_agents:
+        states = []
+        for seed in seeds:
+            state = make_formation(n_agent, seed)
+            states.append(state)
+            # states after a screen, whose screen_one agents have to run
+            screens = [move for move in offense.iter_moves(state) if move["screen"]]
+            for move in screens[:1] + screens[-1:]:
+                states.append(offense.get_successor_state(state, move))
+        assert any(state.screen_one for state in states)
+        for state in states:
+            with contextlib.redirect_stdout(io.StringIO()):
+                moves = offense.refine_possible_moves(state, offense.get_step_1_moves(state))
+            assert moves == list(offense.iter_moves(state))
+
+        def old():
+            n = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                for state in states:
+                    moves = offense.get_step_1_moves(state)
+                    n += len(offense.refine_possible_moves(state, moves))
+            return n
+
+        def new():
+            n = 0
+            for state in states:
+                for _ in offense.iter_moves(state):
+                    n += 1
+            return n
+
+        t_old, n_old = timeit(old, repeat)
+        t_new, n_new = timeit(new, repeat)
+        print("movegen n_offense {}  moves {:6d}  old {:10.0f} moves/s  new {:10.0f} moves/s".format(
+            n_agent // 2, n_new, n_old / t_old, n_new / t_new))
+
+
+def bench_parallel(n_agents, depths, jobs=(1, 2, 4), seeds=(0, 1, 2)):
+    """serial vs process-pool root search, results must be equal"""
+    strategies = {
+        "motion": lambda n_jobs: MotionOffense(0.2, 0.8, search="bounded", n_jobs=n_jobs),
+        "minimax": lambda n_jobs: Minimax(n_jobs=n_jobs),
+    }
+    for n_agent in n_agents:
+        for depth in depths:
+            line = "parallel n_agent {:2d} depth {}".format(n_agent, depth)
+            for name, make in strategies.items():
+                expected = []
+                for n_jobs in jobs:
+                    strategy = make(n_jobs)
+                    results = []
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        for seed in seeds:
+                            state = make_formation(n_agent, seed)
+                            if name == "motion":
+                                results.append(strategy.next_move(state, depth))
+                            else:
+                                results.append(strategy.next_move(0, state, depth))
+                    elapsed = time.perf_counter() - start
+                    strategy.close()
+                    if not expected:
+                        expected = results
+                    assert results == expected, (name, n_jobs)
+                    line += "  {} x{} {:7.3f} s".format(name, n_jobs, elapsed)
+            print(line)
+
+
+def random_leaves(n_agent, n_leaf, seed=0, walk=6):
+    """states reached by walk random agent moves from seeded formations"""
+    rng = random.Random(seed)
+    leaves = []
+    for i in range(n_leaf):
+        state = make_formation(n_agent, seed + i % 8) if i < 8 else copy.copy(leaves[i % 8])
+        state.my_deep_copy()
+        for _ in range(walk):
+            state.apply(rng.randrange(n_agent), rng.choice(Position.legal_moves))
+        leaves.append(state)
+    return leaves
+
+
+def bench_defense(n_agents, n_leaf=2000, repeat=3):
+    """
+    leaf states/sec of State.defense_distance + is_open for every offense
+    agent vs one vector_eval.evaluate_states call, results must be equal
+    """
+    import vector_eval
+
+    for n_agent in n_agents:
+        leaves = random_leaves(n_agent, n_leaf)
+        n_offense = int(n_agent / 2)
+
+        def scalar():
+            rows = []
+            for state in leaves:
+                # measure the feature computation, not the cache of the last repeat
+                state.features = None
+                rows.append([(state.defense_distance(i), state.basket_distance(i),
+                              state.is_open(i)) for i in range(n_offense)])
+            return rows
+
+        def evaluate():
+            values = []
+            for state in leaves:
+                state.features = None
+                values.append(minimax.evaluation_function(state))
+            return values
+
+        t_scalar, expected = timeit(scalar, repeat)
+        for exact in (True, False):
+            t_vector, (min_distance, min_agent_id, basket_distance, is_open) = timeit(
+                lambda: vector_eval.evaluate_states(leaves, exact), repeat)
+            for s, row in enumerate(expected):
+                for i, ((distance, agent_id), basket, flag) in enumerate(row):
+                    assert min_agent_id[s, i] == (-1 if agent_id is None else agent_id)
+                    assert bool(is_open[s, i]) == flag
+                    if exact:
+                        assert min_distance[s, i] == distance
+                        assert basket_distance[s, i] == basket
+            print("defense n_agent {:2d} leaves {}  scalar {:9.0f} leaves/s  "
+                  "vector{} {:9.0f} leaves/s".format(
+                      n_agent, n_leaf, n_leaf / t_scalar, " exact" if exact else "",
+                      n_leaf / t_vector))
+
+        # Minimax.evaluation_function against LeafEvaluator on node ids
+        minimax = Minimax()
+        position = leaves[0].position
+        evaluator = vector_eval.LeafEvaluator(
+            position, position.virtual_to_real(leaves[0].get_basket_virtual_pos()))
+        nodes = [[state.get_agent_node(i) for i in range(n_agent)] for state in leaves]
+        t_scalar, expected = timeit(evaluate, repeat)
+        t_vector, values = timeit(lambda: evaluator.evaluate_nodes(nodes, n_offense), repeat)
+        assert values == expected
+        print("leaf    n_agent {:2d} leaves {}  scalar {:9.0f} leaves/s  "
+              "vector {:9.0f} leaves/s".format(
+                  n_agent, n_leaf, n_leaf / t_scalar, n_leaf / t_vector))
+
+
+def play_frames(n_agent, n_frame, seed=0):
+    """states of a random walk, one agent move per frame"""
+    rng = random.Random(seed)
+    state = make_formation(n_agent, seed)
+    frames = []
+    for _ in range(n_frame):
+        state = state.get_successor_state(rng.randrange(n_agent), rng.choice(Position.legal_moves))
+        frames.append(state)
+    return frames
+
+
+def make_game():
+    """game.Game on the dummy video driver unless a driver is set"""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import game
+
+    court_line = [game.Baseline(), game.Basket(), game.Paint(), game.ThreePointLine()]
+    return game, game.Game(), game.MyColor(), court_line
+
+
+def legacy_draw_agents(state, surf, palette, x_offset, y_offset, factor):
+    """agents as State.draw used to paint them, opening a font per agent"""
+    import pygame
+
+    for text, x, y, r_agent, colors, text_color in state.agent_sprites(
+            palette, x_offset, y_offset, factor):
+        for k, color in enumerate(colors):
+            pygame.draw.circle(surf, color, [x, y], r_agent - 2 * k)
+        font = pygame.font.Font(None, 24)
+        surf.blit(font.render(text, 1, text_color), [x - int(r_agent / 2), y - int(r_agent / 2)])
+
+
+def bench_render(n_agents, n_frame=300):
+    """
+    frame time of full repaints with a font per agent (the old State.draw),
+    with the render cache, and of dirty-rect reset_surf; the frames must be equal
+    """
+    import pygame
+
+    game, window, palette, court_line = make_game()
+    for n_agent in n_agents:
+        frames = play_frames(n_agent, n_frame)
+
+        def uncached():
+            for state in frames:
+                window.draw_background(window.surf, palette, court_line, state)
+                legacy_draw_agents(state, window.surf, palette, window.court_x_offset,
+                                   window.court_y_offset, window.court_factor)
+                pygame.display.update()
+
+        def full():
+            for state in frames:
+                window.redraw_all(palette, court_line, state)
+
+        def dirty():
+            for state in frames:
+                window.reset_surf(palette, court_line, state)
+
+        t_uncached, _ = timeit(uncached, 1)
+        t_full, _ = timeit(full, 1)
+        window.background = None
+        t_dirty, _ = timeit(dirty, 1)
+
+        scratch = pygame.Surface(window.surf.get_size())
+        window.background = None
+        for state in frames[:50]:
+            window.reset_surf(palette, court_line, state)
+            window.render(scratch, palette, court_line, state)
+            assert (pygame.image.tobytes(window.surf, "RGB")
+                    == pygame.image.tobytes(scratch, "RGB"))
+        print("render n_agent {:2d}  frame time: full uncached fonts {:6.2f} ms  "
+              "full {:6.2f} ms  dirty rects {:6.2f} ms".format(
+                  n_agent, 1000 * t_uncached / n_frame, 1000 * t_full / n_frame,
+                  1000 * t_dirty / n_frame))
+
+
+def legacy_get_vpos_link(game, palette, court_lines, state):
+    """the polling link input loop game.py used to run"""
+    import pygame
+    from pygame.locals import MOUSEBUTTONUP
+
+    vpos_stand_place_link = []
+    vpos_pair = []
+    while True:
+        check_ready = False
+        for event in pygame.event.get():
+            if event.type == MOUSEBUTTONUP:
+                if game.is_start_button(event.pos):
+                    check_ready = True
+                    break
+                vpos = game.mouse_to_virtual(state, event.pos)
+                if vpos is None:
+                    continue
+                if event.button == 1:
+                    vpos_pair.append(vpos)
+                    if len(vpos_pair) == 2:
+                        vpos_stand_place_link.append(vpos_pair[:])
+                        vpos_pair = []
+        state.set_agents([], [], vpos_stand_place_link)
+        game.reset_surf(palette, court_lines, state)
+        time.sleep(0.1)
+        if check_ready:
+            break
+
+
+def bench_events(n_link=10, idle=2., seed=0):
+    """
+    input-to-redraw latency and idle CPU of the link input loop, polling
+    (the old one) vs game.get_vpos_link blocking in pygame.event.wait.
+    Clicks are posted from a thread as MOUSEBUTTONUP events.
+    """
+    import threading
+    import pygame
+    from pygame.locals import MOUSEBUTTONUP
+
+    game, window, palette, court_line = make_game()
+    loops = {"polling": legacy_get_vpos_link, "event": game.get_vpos_link}
+    for name, loop in loops.items():
+        state = make_formation(6, seed)
+        rng = random.Random(seed)
+        screen_pos = []
+        for vpos in rng.sample(state.position.virtual_pos, 2 * n_link):
+            real_pos = state.position.virtual_to_real(vpos)
+            screen_pos.append([int(real_pos[0] * window.court_factor + window.court_x_offset),
+                               int(real_pos[1] * window.court_factor + window.court_y_offset)])
+        redraws = []
+        sent = []
+        cpu = []
+        reset_surf = window.reset_surf
+
+        def timed_reset_surf(*args):
+            reset_surf(*args)
+            redraws.append(time.perf_counter())
+
+        def feed():
+            time.sleep(0.3)
+            for k, pos in enumerate(screen_pos):
+                if k % 2 == 1:
+                    sent.append(time.perf_counter())
+                pygame.event.post(pygame.event.Event(MOUSEBUTTONUP, pos=pos, button=1))
+                time.sleep(0.05 + rng.random() * 0.1)
+            wall = time.perf_counter()
+            process = time.process_time()
+            time.sleep(idle)
+            cpu.append((time.process_time() - process) / (time.perf_counter() - wall))
+            pygame.event.post(pygame.event.Event(MOUSEBUTTONUP, pos=window.start_button[:2], button=1))
+
+        window.reset_surf = timed_reset_surf
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        loop(window, palette, court_line, state)
+        feeder.join()
+        window.reset_surf = reset_surf
+
+        latency = [min(r for r in redraws if r >= t) - t for t in sent]
+        print("events {:8s} links {:3d}  latency mean {:6.1f} ms  max {:6.1f} ms  "
+              "idle cpu {:5.1f} %  redraws {}".format(
+                  name, len(state.stand_place_pairs) // 2, 1000 * sum(latency) / len(latency),
+                  1000 * max(latency), 100 * cpu[0], len(redraws)))
+
+
+def legacy_features(state, agent_id):
+    """basket_distance and defense_distance as State computed them from scratch"""
+    def cross_product(a, b):
+        return a[0] * b[0] + a[1] * b[1]
+
+    position = state.position
+    vpos_basket = state.get_basket_virtual_pos()
+    virtual_off = state.get_agent_virtual_pos(agent_id)
+    basket_distance = position.real_distance(virtual_off, vpos_basket)
+    min_distance = None
+    min_agent_id = None
+    for j in range(int(state.n_agent / 2), state.n_agent):
+        virtual_def = state.get_agent_virtual_pos(j)
+        real_off = position.virtual_to_real(virtual_off)
+        real_def = position.virtual_to_real(virtual_def)
+        real_basket = position.virtual_to_real(vpos_basket)
+        vector_off = [a - b for a, b in zip(real_basket, real_off)]
+        vector_def = [a - b for a, b in zip(real_def, real_off)]
+        if cross_product(vector_off, vector_def) > 0:
+            if min_distance is None or position.real_distance(virtual_off, virtual_def) < min_distance:
+                min_distance = position.real_distance(virtual_off, virtual_def)
+                min_agent_id = j
+    if min_distance is None:
+        return basket_distance, -1, None
+    return basket_distance, min_distance, min_agent_id
+
+
+class FullState(State):
+    """State without occupancy and features: every query scans all agents"""
+    def set_agent_pos(self, agent_id, vpos, node=None):
+        if node is None:
+            node = self.position.node_id(vpos)
+        self.agents[agent_id].set_vpos(vpos, node)
+
+    def node_is_null(self, agent_id, node):
+        for i in range(len(self.agents)):
+            if i != agent_id and self.get_agent_node(i) == node:
+                return False
+        return True
+
+    def basket_distance(self, agent_id):
+        return legacy_features(self, agent_id)[0]
+
+    def defense_distance(self, agent_id):
+        return legacy_features(self, agent_id)[1:]
+
+
+def check_incremental(state, rng):
+    """occupancy and features of state must equal a full recomputation"""
+    occupancy = {}
+    for i in range(len(state.agents)):
+        node = state.position.node_id(state.get_agent_virtual_pos(i))
+        if node is not None:
+            occupancy.setdefault(node, []).append(i)
+    assert {node: sorted(ids) for node, ids in state.occupancy.items()} == occupancy
+    if state.features is None and rng.random() < 0.5:
+        state.build_features()
+    for i in range(int(state.n_agent / 2)):
+        basket_distance, min_distance, min_agent_id = legacy_features(state, i)
+        assert state.basket_distance(i) == basket_distance
+        assert state.defense_distance(i) == (min_distance, min_agent_id)
+
+
+def verify_incremental(n_agents, n_walk=200, n_step=50, seed=0):
+    """
+    random walks of single agent moves, MotionOffense moves, undos,
+    copies and set_compact, checked against full recomputation after
+    every step
+    """
+    rng = random.Random(seed)
+    offense = MotionOffense(0.2, 0.8)
+    formations = {}
+
+    def formation(n_agent, seed):
+        """copy of make_formation, the court is only built once"""
+        if (n_agent, seed) not in formations:
+            formations[(n_agent, seed)] = make_formation(n_agent, seed)
+        state = copy.copy(formations[(n_agent, seed)])
+        state.my_deep_copy()
+        return state
+
+    n_check = 0
+    for n_agent in n_agents:
+        for walk in range(n_walk):
+            state = formation(n_agent, walk % 16)
+            tokens = []
+            for _ in range(n_step):
+                r = rng.random()
+                if r < 0.5:
+                    tokens.append((None, state.apply(rng.randrange(n_agent),
+                                                     rng.choice(state.get_legal_moves()))))
+                elif r < 0.65:
+                    if not all(state.get_agent_node(i) in state.stand_place_adj
+                               for i in range(n_agent // 2)):
+                        continue  # MotionOffense moves need the offense on stand places
+                    moves = list(offense.iter_moves(state))
+                    if moves:
+                        tokens.append((offense, offense.apply(state, rng.choice(moves))))
+                elif r < 0.85 and tokens:
+                    strategy, token = tokens.pop()
+                    if strategy is None:
+                        state.undo(token)
+                    else:
+                        strategy.undo(state, token)
+                elif r < 0.95:
+                    state = state.get_successor_state(rng.randrange(n_agent),
+                                                      rng.choice(state.get_legal_moves()))
+                    tokens = []
+                else:
+                    other = formation(n_agent, walk % 16)
+                    other.set_compact(state.compact())
+                    state = other
+                    tokens = []
+                check_incremental(state, rng)
+                n_check += 1
+    print("incremental check: {} states of {} agents match full recomputation".format(
+        n_check, "/".join(str(n) for n in n_agents)))
+
+
+def bench_incremental(n_agents, depths=(3, 4), seeds=(0, 1, 2)):
+    """
+    Minimax leaf evaluations/sec with incremental occupancy and features
+    against full recomputation per query; the searches must agree
+    """
+    from stats import SearchStats
+
+    for n_agent in n_agents:
+        for depth in depths:
+            line = "incremental n_agent {:2d} depth {}".format(n_agent, depth)
+            results = []
+            for name, state_class in (("full", FullState), ("incremental", State)):
+                minimax = Minimax()
+                stats = minimax.set_stats(SearchStats())
+                states = [make_formation(n_agent, seed, state_class=state_class) for seed in seeds]
+                start = time.perf_counter()
+                moves = [minimax.next_move(0, state, depth) for state in states]
+                elapsed = time.perf_counter() - start
+                results.append(moves)
+                leaves = stats.counters.get("leaf_evals", 0)
+                line += "  {} {:8d} leaves {:7.3f} s {:9.0f} evals/s".format(
+                    name, leaves, elapsed, leaves / elapsed)
+            assert results[0] == results[1]
+            print(line)
+
+
+def bench_movecache(n_agents, depths, seeds=(0, 1, 2), warm_formations=200):
+    """
+    MotionOffense.next_move without the move cache, with a cold cache and
+    after warm_up of each formation (every seed has its own stand place
+    graph, which empties the cache); results must be equal. Hit rate and
+    memory are those of the cold cache after the last seed.
+    """
+    for n_agent in n_agents:
+        kwargs = SUITE_MOTION_SEARCH[n_agent]
+        for depth in depths:
+            if n_agent > 6 and depth > 3:
+                continue
+            line = "movecache n_agent {:2d} depth {}".format(n_agent, depth)
+            results = []
+            for name in ("off", "cold", "warm"):
+                offense = MotionOffense(0.2, 0.8, **kwargs)
+                if name == "off":
+                    offense.move_cache_size = 0
+                elapsed = 0.
+                warm_time = 0.
+                n_formation = 0
+                moves = []
+                for seed in seeds:
+                    state = make_formation(n_agent, seed)
+                    if name == "warm":
+                        start = time.perf_counter()
+                        n_formation += offense.warm_up(state, warm_formations)
+                        warm_time += time.perf_counter() - start
+                    start = time.perf_counter()
+                    moves.append(offense.next_move(state, depth))
+                    elapsed += time.perf_counter() - start
+                results.append(moves)
+                if name == "warm":
+                    line += "  warm-up {} formations {:6.3f} s".format(n_formation, warm_time)
+                line += "  {} {:7.3f} s".format(name, elapsed)
+                if name == "cold":
+                    info = offense.move_cache_info()
+            assert results[0] == results[1] == results[2]
+            print(line + "  hit rate {:5.1%} formations {} moves {} memory {:.1f} MB".format(
+                info["hit_rate"], info["formations"], info["moves"], info["bytes"] / 1e6))
+
+
+def bench_rollout(n_agents, jobs=(1, 2, 4), depth=4, n_rollout=1000000, seeds=(0, 1, 2)):
+    """
+    rollout.rollout of the depth step play MotionOffense picks, serial and
+    in process pools; results must be equal and the sampled probability
+    that every defender catches up must agree with exp(log_p)
+    """
+    import rollout
+
+    for n_agent in n_agents:
+        offense = MotionOffense(0.2, 0.8, **SUITE_MOTION_SEARCH[n_agent])
+        for seed in seeds:
+            state = make_formation(n_agent, seed)
+            moves = rollout.plan_play(offense, state, depth)
+            events = rollout.compile_play(offense, state, moves)
+            line = "rollout n_agent {:2d} seed {} steps {} events {:2d}".format(
+                n_agent, seed, len(moves), len(events["step"]))
+            results = []
+            for n_jobs in jobs:
+                start = time.perf_counter()
+                results.append(rollout.rollout(events, n_rollout, n_agent, seed, n_jobs))
+                line += "  jobs {} {:6.3f} s".format(n_jobs, time.perf_counter() - start)
+            assert all(result == results[0] for result in results)
+            result = results[0]
+            low, high = result["ci"]
+            exact = result["p_defended_exact"]
+            assert 1 - high - 1e-3 <= exact <= 1 - low + 1e-3
+            print(line + "  p_open {:.4f} [{:.4f}, {:.4f}] exact {:.4f}".format(
+                result["p_open"], low, high, 1 - exact))
+
+
+def bench_compact(n_agents, seeds=(0, 1, 2), n_state=20000, repeat=3):
+    """
+    memory per stored state and successor generation throughput,
+    full State copies vs CompactState snapshots
+    """
+    for n_agent in n_agents:
+        states = [make_formation(n_agent, seed) for seed in seeds]
+        successors = []
+        for state in states:
+            for agent_id in range(n_agent):
+                for move in Position.legal_moves:
+                    token = state.apply(agent_id, move)
+                    if token is not None:
+                        successors.append((state, agent_id, move))
+                        state.undo(token)
+
+        def full():
+            for state, agent_id, move in successors:
+                state.get_successor_state(agent_id, move)
+            return len(successors)
+
+        def compact():
+            for state, agent_id, move in successors:
+                token = state.apply(agent_id, move)
+                state.compact()
+                state.undo(token)
+            return len(successors)
+
+        t_full, n = timeit(full, repeat)
+        t_compact, _ = timeit(compact, repeat)
+
+        def measure(make):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            kept = [make(states[i % len(states)]) for i in range(n_state)]
+            size = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            del kept
+            return size / n_state
+
+        def full_copy(state):
+            copied = copy.copy(state)
+            copied.my_deep_copy()
+            return copied
+
+        mem_full = measure(full_copy)
+        mem_compact = measure(lambda state: state.compact())
+        restored = make_formation(n_agent, seeds[0])
+        restored.set_compact(states[0].compact())
+        assert restored.compact() == states[0].compact()
+        assert isinstance(states[0].compact(), CompactState)
+        print("compact n_agent {:2d}  state {:6.0f} B  compact {:4.0f} B  "
+              "successors/s full {:9.0f}  compact {:9.0f}".format(
+                  n_agent, mem_full, mem_compact, n / t_full, n / t_compact))
+
+
+# the suite: seeded cases on fixed courts, timed without their setup
+SUITE_COURTS = ["half_0.9", "half_0.5", "full_0.5"]
+SUITE_N_AGENTS = [6, 10]
+SUITE_SEEDS = [0, 1, 2]
+# exact searches of 10 agents take minutes from depth 3 on
+SUITE_MOTION_SEARCH = {6: dict(search="bounded"), 10: dict(search="beam", beam_width=4)}
+
+
+def suite_cases():
+    """
+    Returns
+    -------
+    cases: list of (name, setup)
+        setup() prepares a fresh case and returns the function to time,
+        so caches never carry over between repeats
+    """
+    cases = []
+    for court in SUITE_COURTS:
+        rect, x_offset, y_offset, factor = COURTS[court]
+
+        def lattice(rect=rect, x_offset=x_offset, y_offset=y_offset, factor=factor):
+            position = Position(rect, x_offset, y_offset, factor, path_table=False)
+            return position.build_lattice
+
+        def path_table(rect=rect, x_offset=x_offset, y_offset=y_offset, factor=factor):
+            return lambda: Position(rect, x_offset, y_offset, factor, path_table=True)
+
+        def shortest_path(rect=rect, x_offset=x_offset, y_offset=y_offset, factor=factor):
+            position = Position(rect, x_offset, y_offset, factor, path_table=True)
+            rng = random.Random(0)
+            pairs = [(rng.choice(position.virtual_pos), rng.choice(position.virtual_pos))
+                     for _ in range(2000)]
+            return lambda: [position.get_shortest_path(a, b) for a, b in pairs]
+
+        cases.append(("lattice/" + court, lattice))
+        cases.append(("path_table/" + court, path_table))
+        cases.append(("shortest_path/" + court, shortest_path))
+
+    for n_agent in SUITE_N_AGENTS:
+        for court in SUITE_COURTS[:2]:
+            def defense(n_agent=n_agent, court=court):
+                leaves = [make_formation(n_agent, seed, court) for seed in range(50)]
+                n_offense = int(n_agent / 2)
+                return lambda: [(state.defense_distance(i), state.is_open(i))
+                                for state in leaves for i in range(n_offense)]
+
+            def movegen(n_agent=n_agent, court=court):
+                states = [make_formation(n_agent, seed, court) for seed in SUITE_SEEDS]
+                offense = MotionOffense(0.2, 0.8)
+                return lambda: [offense.refine_possible_moves(state, offense.get_step_1_moves(state))
+                                for state in states]
+
+            tag = "/n{}/{}".format(n_agent, court)
+            cases.append(("defense" + tag, defense))
+            cases.append(("movegen" + tag, movegen))
+
+        for depth in (1, 2, 3, 4):
+            def motion(n_agent=n_agent, depth=depth):
+                states = [make_formation(n_agent, seed) for seed in SUITE_SEEDS]
+                offense = MotionOffense(0.2, 0.8, **SUITE_MOTION_SEARCH[n_agent])
+                return lambda: [offense.next_move(state, depth) for state in states]
+            cases.append(("motion/n{}/d{}".format(n_agent, depth), motion))
+
+        for depth in (1, 2, 3):
+            def minimax(n_agent=n_agent, depth=depth):
+                states = [make_formation(n_agent, seed) for seed in SUITE_SEEDS]
+                strategy = Minimax()
+                return lambda: [strategy.next_move(0, state, depth) for state in states]
+            cases.append(("minimax/n{}/d{}".format(n_agent, depth), minimax))
+
+        def render(n_agent=n_agent):
+            game, window, palette, court_line = make_game()
+            frames = play_frames(n_agent, 100)
+            window.reset_surf(palette, court_line, frames[0])
+
+            def run():
+                for state in frames:
+                    window.reset_surf(palette, court_line, state)
+            return run
+        cases.append(("render/n{}".format(n_agent), render))
+    return cases
+
+
+def run_suite(repeat=3, only=None, progress=sys.stderr):
+    """
+    Time every suite case whose name contains one of the strings in only
+    (all if None).
+
+    Returns
+    -------
+    report: dict
+        {"meta": {...}, "results": {name: {"best": s, "median": s, "runs": [s, ...]}}}
+    """
+    results = {}
+    for name, setup in suite_cases():
+        if only and not any(pattern in name for pattern in only):
+            continue
+        runs = []
+        for _ in range(repeat):
+            func = setup()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                func()
+                runs.append(time.perf_counter() - start)
+        results[name] = {"best": min(runs), "median": sorted(runs)[len(runs) // 2], "runs": runs}
+        if progress is not None:
+            print("{:32s} {:10.3f} ms".format(name, 1000 * min(runs)), file=progress)
+    meta = {"python": platform.python_version(), "machine": platform.machine(),
+            "platform": platform.platform(), "repeat": repeat,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+    return {"meta": meta, "results": results}
+
+
+def compare(baseline, report, threshold=0.15, min_time=1e-3):
+    """
+    Compare the best times of report with baseline. A case regressed if
+    it got slower by more than threshold (relative) and min_time seconds.
+
+    Returns
+    -------
+    regressions: list of str
+        names of the regressed cases
+    """
+    regressions = []
+    old_results = baseline["results"]
+    for name, result in report["results"].items():
+        if name not in old_results:
+            print("{:32s} {:10.3f} ms  new case".format(name, 1000 * result["best"]))
+            continue
+        old = old_results[name]["best"]
+        new = result["best"]
+        ratio = new / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold and new - old > min_time:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold and old - new > min_time:
+            flag = "  faster"
+        print("{:32s} {:10.3f} ms -> {:10.3f} ms  x{:5.2f}{}".format(
+            name, 1000 * old, 1000 * new, ratio, flag))
+    for name in old_results:
+        if name not in report["results"]:
+            print("{:32s} missing".format(name))
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Basketball simulator benchmarks")
+    parser.add_argument("bench", nargs="*", default=["lattice"],
+                        help="benchmarks to run (lattice, startup, minimax, motion, movegen, "
+                             "compact, parallel, defense, render, events, pick, suite, incremental, "
+                             "movecache, rollout)")
+    parser.add_argument("--court", nargs="*", default=list(COURTS),
+                        help="court presets: " + ", ".join(COURTS))
+    parser.add_argument("--n_agent", type=int, nargs="*", default=[6, 10],
+                        help="formation sizes")
+    parser.add_argument("--depth", type=int, nargs="*", default=[1, 2, 3],
+                        help="search depths")
+    parser.add_argument("--jobs", type=int, nargs="*", default=[1, 2, 4],
+                        help="process counts of the parallel benchmark")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="repeat each measurement and keep the best")
+    parser.add_argument("-o", "--output",
+                        help="suite: write the results as JSON to this file")
+    parser.add_argument("--baseline",
+                        help="suite: compare with this JSON result file, exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="suite: relative slowdown counted as a regression")
+    parser.add_argument("--only", nargs="*",
+                        help="suite: run only cases whose name contains one of these")
+    parser.add_argument("--check", action="store_true",
+                        help="incremental: first verify incremental state against "
+                             "full recomputation on random walks")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    for bench in args.bench:
+        if bench == "lattice":
+            bench_lattice(args.court, args.repeat)
+        elif bench == "startup":
+            bench_startup(args.court, args.repeat)
+        elif bench == "minimax":
+            bench_minimax(args.n_agent, args.depth)
+        elif bench == "motion":
+            bench_motion(args.n_agent, args.depth)
+        elif bench == "movegen":
+            bench_movegen(args.n_agent, repeat=args.repeat)
+        elif bench == "compact":
+            bench_compact(args.n_agent, repeat=args.repeat)
+        elif bench == "suite":
+            report = run_suite(args.repeat, args.only)
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(report, f, indent=1)
+            if args.baseline:
+                with open(args.baseline) as f:
+                    baseline = json.load(f)
+                if args.only:
+                    baseline["results"] = {
+                        name: result for name, result in baseline["results"].items()
+                        if any(pattern in name for pattern in args.only)}
+                if compare(baseline, report, args.threshold):
+                    sys.exit(1)
+        elif bench == "incremental":
+            if args.check:
+                verify_incremental(args.n_agent)
+            bench_incremental(args.n_agent)
+        elif bench == "movecache":
+            bench_movecache(args.n_agent, args.depth)
+        elif bench == "rollout":
+            bench_rollout(args.n_agent, args.jobs)
+        elif bench == "pick":
+            bench_pick(args.court, repeat=args.repeat)
+        elif bench == "events":
+            bench_events()
+        elif bench == "render":
+            bench_render(args.n_agent)
+        elif bench == "defense":
+            bench_defense(args.n_agent, repeat=args.repeat)
+        elif bench == "parallel":
+            bench_parallel(args.n_agent, args.depth, args.jobs)
+        else:
+            sys.exit("unknown benchmark {}".format(bench))
@@ -1,12 +1,14 @@
 import sys
 import pygame
-import time
 import math
 import argparse
 from pygame.locals import *
 
 from strategy import *
 from state import *
+import geometry_cache
+import playback
+from stats import SearchStats
 
 
 class CourtLine:
@@ -87,82 +89,6 @@ class MyColor:
         self.blue = (0, 0, 255)
 
 
-class Position:
-    def __init__(self, rect, x_offset, y_offset, factor=1):
-        """
-        Parameters
-        ---------
-        rect: [x, y, width, height]
-            court size
-        x_offset: float
-            start point x
-        y_offset: float
-            start point y
-        factor: int
-            factor of edge of six-direction
-        """
-        self.rect = rect
-        self.x_offset = x_offset
-        self.y_offset = y_offset
-        self.factor = factor
-
-        def virtual_to_real(virtual_pos):
-            real_x = virtual_pos[0] * math.sqrt(3) / 2 * factor + x_offset
-            real_y = virtual_pos[1] / 2 * factor + y_offset
-            return [real_x, real_y]
-
-        def is_in(rect, pos):
-            """test if pos in rect"""
-            x = pos[0]
-            y = pos[1]
-            if x < rect[0] or x > rect[0] + rect[2]:
-                return False
-            if y < rect[1] or y > rect[1] + rect[3]:
-                return False
-            return True
-
-        def dfs(rect, x, y, pos):
-            if ([x, y+2] not in pos and
-                    is_in(rect, virtual_to_real([x, y+2]))):
-                pos.append([x, y+2])
-                dfs(rect, x, y+2, pos)
-            if ([x, y-2] not in pos and
-                    is_in(rect, virtual_to_real([x, y-2]))):
-                pos.append([x, y-2])
-                dfs(rect, x, y-2, pos)
-            if ([x+1, y-1] not in pos and
-                    is_in(rect, virtual_to_real([x+1, y-1]))):
-                pos.append([x+1, y-1])
-                dfs(rect, x+1, y-1, pos)
-            if ([x+1, y+1] not in pos and
-                    is_in(rect, virtual_to_real([x+1, y+1]))):
-                pos.append([x+1, y+1])
-                dfs(rect, x+1, y+1, pos)
-            if ([x-1, y+1] not in pos and
-                    is_in(rect, virtual_to_real([x-1, y+1]))):
-                pos.append([x-1, y+1])
-                dfs(rect, x-1, y+1, pos)
-            if ([x-1, y-1] not in pos and
-                    is_in(rect, virtual_to_real([x-1, y-1]))):
-                pos.append([x-1, y-1])
-                dfs(rect, x-1, y-1, pos)
-
-        self.virtual_pos = []  # store int coordinate
-        dfs(rect, 0, 0, self.virtual_pos)
-
-        self.real_pos = []
-        for pos in self.virtual_pos:
-            self.real_pos.append(virtual_to_real(pos))
-
-    def get_real_pos(self):
-        return self.real_pos
-
-    def draw(self, surf, palette, x_offset, y_offset, factor=1):
-        for pos in self.real_pos:
-            x = int(pos[0] * factor + x_offset)
-            y = int(pos[1] * factor + y_offset)
-            pygame.draw.circle(surf, palette.black, [x, y], 2)
-
 class Game:
     def __init__(self):
         pygame.init()
@@ -171,14 +97,92 @@ class Game:
         self.court_factor = 30
         self.court_x_offset = 50
         self.court_y_offset = 50
-
-    def reset_surf(self, palette, court_lines, state):
-        self.surf.fill(palette.white)
+        # cached static layers of reset_surf and the agents drawn on top
+        self.background = None
+        self.background_key = None
+        self.sprites = {}
+
+    def draw_background(self, surf, palette, court_lines, state):
+        """everything but the agents: court lines, lattice, links and start button"""
+        surf.fill(palette.white)
         for court_line in court_lines:
-            court_line.draw(self.surf, palette, self.court_x_offset, self.court_y_offset, self.court_factor)
-        state.draw(self.surf, palette, self.court_x_offset, self.court_y_offset, self.court_factor)
-        pygame.draw.rect(self.surf, (200, 200, 200), self.start_button)
+            court_line.draw(surf, palette, self.court_x_offset, self.court_y_offset, self.court_factor)
+        state.draw_lattice(surf, self.court_x_offset, self.court_y_offset, self.court_factor)
+        state.draw_links(surf, palette, self.court_x_offset, self.court_y_offset, self.court_factor)
+        pygame.draw.rect(surf, (200, 200, 200), self.start_button)
+
+    def render(self, surf, palette, court_lines, state):
+        """the whole frame of state on surf"""
+        self.draw_background(surf, palette, court_lines, state)
+        for sprite in state.agent_sprites(palette, self.court_x_offset,
+                                          self.court_y_offset, self.court_factor):
+            state.draw_sprite(surf, sprite)
+
+    def redraw_all(self, palette, court_lines, state):
+        """repaint and flip the whole window"""
+        self.render(self.surf, palette, court_lines, state)
         pygame.display.update()
+        self.background = None
+
+    def reset_surf(self, palette, court_lines, state):
+        """
+        Draw state. The static layers are rendered once into
+        self.background, and while they stay the same only the rects of
+        agents that moved or changed are restored from it, redrawn and
+        passed to pygame.display.update.
+        """
+        sprites = {}
+        for sprite in state.agent_sprites(palette, self.court_x_offset,
+                                          self.court_y_offset, self.court_factor):
+            sprites[sprite[0]] = sprite
+        self.draw_sprites(palette, court_lines, state, sprites)
+
+    def draw_sprites(self, palette, court_lines, state, sprites):
+        """
+        reset_surf with the given sprites, a dict of key -> sprite tuple
+        (see State.draw_sprite) drawn in order on the background of state
+        """
+        key = (tuple(id(court_line) for court_line in court_lines), id(state.position),
+               frozenset(state.stand_place_pairs))
+        if self.background is None or key != self.background_key:
+            self.background = pygame.Surface(self.surf.get_size())
+            self.draw_background(self.background, palette, court_lines, state)
+            self.background_key = key
+            self.surf.blit(self.background, (0, 0))
+            for sprite in sprites.values():
+                state.draw_sprite(self.surf, sprite)
+            self.sprites = sprites
+            pygame.display.update()
+            return
+
+        dirty = []
+        for text in set(self.sprites) | set(sprites):
+            old = self.sprites.get(text)
+            new = sprites.get(text)
+            if old != new:
+                if old is not None:
+                    dirty.append(state.sprite_rect(old))
+                if new is not None:
+                    dirty.append(state.sprite_rect(new))
+        self.sprites = sprites
+        if not dirty:
+            return
+        rects = [(sprite, state.sprite_rect(sprite)) for sprite in sprites.values()]
+        for rect in dirty:
+            # repaint rect as the full frame would: background, then agents in order
+            self.surf.blit(self.background, rect, rect)
+            self.surf.set_clip(rect)
+            for sprite, sprite_rect in rects:
+                if sprite_rect.colliderect(rect):
+                    state.draw_sprite(self.surf, sprite)
+            self.surf.set_clip(None)
+        pygame.display.update(dirty)
+
+    def mouse_to_virtual(self, state, pos):
+        """closest lattice place to a window position, None if there is none"""
+        rx = (pos[0] - self.court_x_offset) / self.court_factor
+        ry = (pos[1] - self.court_y_offset) / self.court_factor
+        return state.real_to_close_virtual([rx, ry])
 
     def is_start_button(self, pos):
         check = True
@@ -195,94 +199,96 @@ def get_args():
                         help="# of agent (6 or 10)")
     parser.add_argument("--time_step", type=int, default=2,
                         help="search depth")
+    parser.add_argument("--fps", type=int, default=30,
+                        help="frame rate of the play animation")
+    parser.add_argument("--step_time", type=float, default=1.,
+                        help="seconds per animated step of the play")
+    parser.add_argument("--cache_dir", type=str, default=geometry_cache.DEFAULT_CACHE_DIR,
+                        help="court geometry cache directory, empty to disable")
+    parser.add_argument("--stats", type=str, default="",
+                        help="write the search statistics of the play as JSON to this file")
+    parser.add_argument("--trace", type=str, default="",
+                        help="write a Chrome trace of the search to this file")
     return parser.parse_args()
 
 
-def get_vpos_link(game, state):
+def wait_click():
+    """
+    Block until the next mouse button release and return it; the window
+    is only redrawn when it was exposed, not on a timer.
+    """
+    while True:
+        event = pygame.event.wait()
+        if event.type == QUIT:
+            pygame.quit()
+            sys.exit()
+        elif event.type == VIDEOEXPOSE:
+            pygame.display.update()
+        elif event.type == MOUSEBUTTONUP:
+            return event
+
+
+def get_vpos_link(game, palette, court_lines, state):
     vpos_stand_place_link = []
     vpos_pair = []
+    state.set_agents([], [], vpos_stand_place_link)
+    game.reset_surf(palette, court_lines, state)
     while True:
-        mouse_clicked = False
-        check_ready = False
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == MOUSEBUTTONUP:
-                mouse_x, mouse_y = event.pos
-                if game.is_start_button([mouse_x, mouse_y]):
-                    check_ready = True
-                    break
-                rx = mouse_x
-                ry = mouse_y
-                rx -= game.court_x_offset
-                ry -= game.court_y_offset
-                rx = rx / game.court_factor
-                ry = ry / game.court_factor
-                vpos = state.real_to_close_virtual([rx, ry])
-                if vpos is None:
-                    continue
-                if event.button == 1:  # left click
-                    vpos_pair.append(vpos)
-                    if len(vpos_pair) == 2:
-                        vpos_stand_place_link.append(vpos_pair[:])
-                        vpos_pair = []
-        state.set_agents([], [], vpos_stand_place_link)
-        game.reset_surf(palette, court_line, state)
-        time.sleep(0.1)
-        if check_ready:
+        event = wait_click()
+        if game.is_start_button(event.pos):
             break
-
-
-def get_vpos_start(game, state):
+        vpos = game.mouse_to_virtual(state, event.pos)
+        if vpos is None:
+            continue
+        if event.button == 1:  # left click
+            vpos_pair.append(vpos)
+            if len(vpos_pair) == 2:
+                vpos_stand_place_link.append(vpos_pair[:])
+                vpos_pair = []
+                state.set_agents([], [], vpos_stand_place_link)
+                game.reset_surf(palette, court_lines, state)
+
+
+def get_vpos_start(game, palette, court_lines, state):
     vpos_start_offense = []
     vpos_start_defense = []
+    state.set_agents(vpos_start_offense, vpos_start_defense)
+    game.reset_surf(palette, court_lines, state)
     while True:
-        mouse_clicked = False
-        check_ready = False
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == MOUSEBUTTONUP:
-                mouse_x, mouse_y = event.pos
-                if game.is_start_button([mouse_x, mouse_y]) and\
-                len(vpos_start_offense) == int(state.n_agent / 2) and\
-                len(vpos_start_defense) == int(state.n_agent / 2):
-                    check_ready = True
-                    break
-                rx = mouse_x
-                ry = mouse_y
-                rx -= game.court_x_offset
-                ry -= game.court_y_offset
-                rx = rx / game.court_factor
-                ry = ry / game.court_factor
-                vpos = state.real_to_close_virtual([rx, ry])
-                if vpos is None:
-                    continue
-                if event.button == 1:  # left click
-                    if vpos in vpos_start_offense:
-                        tmp = []
-                        for x in vpos_start_offense:
-                            if x != vpos:
-                                tmp.append(x)
-                        vpos_start_offense = tmp
-                    elif len(vpos_start_offense) < int(state.n_agent / 2):
-                        vpos_start_offense.append(vpos)
-                elif event.button == 3:  # right click
-                    if vpos in vpos_start_defense:
-                        tmp = []
-                        for x in vpos_start_defense:
-                            if x != vpos:
-                                tmp.append(x)
-                        vpos_start_defense = tmp
-                    elif len(vpos_start_defense) < int(state.n_agent / 2):
-                        vpos_start_defense.append(vpos)
-        state.set_agents(vpos_start_offense, vpos_start_defense)
-        game.reset_surf(palette, court_line, state)
-        time.sleep(0.1)
-        if check_ready:
+        event = wait_click()
+        if game.is_start_button(event.pos) and\
+        len(vpos_start_offense) == int(state.n_agent / 2) and\
+        len(vpos_start_defense) == int(state.n_agent / 2):
             break
+        vpos = game.mouse_to_virtual(state, event.pos)
+        if vpos is None:
+            continue
+        if event.button == 1:  # left click
+            if vpos in vpos_start_offense:
+                tmp = []
+                for x in vpos_start_offense:
+                    if x != vpos:
+                        tmp.append(x)
+                vpos_start_offense = tmp
+            elif len(vpos_start_offense) < int(state.n_agent / 2):
+                vpos_start_offense.append(vpos)
+            else:
+                continue
+        elif event.button == 3:  # right click
+            if vpos in vpos_start_defense:
+                tmp = []
+                for x in vpos_start_defense:
+                    if x != vpos:
+                        tmp.append(x)
+                vpos_start_defense = tmp
+            elif len(vpos_start_defense) < int(state.n_agent / 2):
+                vpos_start_defense.append(vpos)
+            else:
+                continue
+        else:
+            continue
+        state.set_agents(vpos_start_offense, vpos_start_defense)
+        game.reset_surf(palette, court_lines, state)
 
 
 if __name__ == "__main__":
@@ -295,12 +301,13 @@ if __name__ == "__main__":
                   court_line[1].get_basket()[0],
                   court_line[1].get_basket()[1],
                   factor=0.9,
-                  n_agent=args.n_agent)
+                  n_agent=args.n_agent,
+                  cache_dir=args.cache_dir or None)
 
     game.reset_surf(palette, court_line, state)
 
-    get_vpos_link(game, state)
-    get_vpos_start(game, state)
+    get_vpos_link(game, palette, court_line, state)
+    get_vpos_start(game, palette, court_line, state)
 
     p_screen = 0.2  # prob that defense_agent could catch up
     p_unscreen = 0.8  # prob that defense_agent could catch up under screen
@@ -309,6 +316,8 @@ if __name__ == "__main__":
     defense_strategy = MotionDefense()
     #offense_strategy = Brownian()
     offense_strategy = MotionOffense(p_screen, p_unscreen)
+    if args.stats or args.trace:
+        offense_strategy.set_stats(SearchStats(trace=bool(args.trace)))
 
     """
     while True:
@@ -334,11 +343,12 @@ if __name__ == "__main__":
     """
     time_step = args.time_step
 
-    while True:
-        move, log_p = offense_strategy.next_move(state, time_step)
-        print("QQ", move, log_p)
-        time_step -= 1
-        state = offense_strategy.get_successor_state(state, move)
-        if time_step == 0:
-            break
-    time.sleep(10000)
+    playback.play(game, palette, court_line, state, offense_strategy,
+                  time_step, fps=args.fps, step_time=args.step_time)
+    if args.stats:
+        offense_strategy.stats.write_json(args.stats)
+    if args.trace:
+        offense_strategy.stats.write_chrome_trace(args.trace)
+    while pygame.event.wait().type != QUIT:
+        pass
+    pygame.quit()
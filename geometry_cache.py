@@ -0,0 +1,180 @@
+"""
+On-disk cache of built court geometry.
+
+A court is keyed by (rect, x_offset, y_offset, factor). Its lattice nodes,
+real coordinates, adjacency and path tables are written to one flat binary
+file that is memory-mapped on load, so the tables are paged in lazily and
+shared between processes reading the same court.
+
+File layout (little-endian, every section 8-byte aligned):
+    header     magic, version, n_node, has_path_table,
+               crc32 of the lattice sections, crc32 of the path table,
+               rect[4], x_offset, y_offset, factor
+    virtual_pos  int32[n_node * 2]
+    real_pos     float64[n_node * 2]
+    neighbors    int32[n_node * 6], -1 for a missing neighbor
+    dist         int32[n_node * n_node]  (only with path table)
+    parent       int32[n_node * n_node]  (only with path table)
+    next_hop     int32[n_node * n_node]  (only with path table)
+
+A file is only used when its magic, VERSION, key, size and the crc32 of
+the lattice sections match. The path table crc32 is only checked by
+load(verify=True): checking it reads every page of the table, which is
+what the lazy mapping avoids. Bump VERSION whenever the lattice builder, the node order or the path
+table semantics change; older files are then ignored and overwritten.
+"""
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import zlib
+import warnings
+from array import array
+
+MAGIC = b"BSGEOM\0\0"
+VERSION = 2
+HEADER = struct.Struct("<8sIIIII4x7d")
+LATTICE_SECTIONS = 3  # virtual_pos, real_pos, neighbors
+MAX_NEIGHBOR = 6
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "basketball_simulator")
+
+
+def cache_key(rect, x_offset, y_offset, factor):
+    return tuple(float(x) for x in rect) + (float(x_offset), float(y_offset), float(factor))
+
+
+def cache_path(cache_dir, key):
+    digest = hashlib.sha1(repr((VERSION,) + key).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "geometry_v{}_{}.bin".format(VERSION, digest))
+
+
+def _sections(n_node, has_path_table):
+    """list of (name, typecode, length)"""
+    sections = [("virtual_pos", "i", n_node * 2),
+                ("real_pos", "d", n_node * 2),
+                ("neighbors", "i", n_node * MAX_NEIGHBOR)]
+    if has_path_table:
+        sections += [("dist", "i", n_node * n_node),
+                     ("parent", "i", n_node * n_node),
+                     ("next_hop", "i", n_node * n_node)]
+    return sections
+
+
+def _section_size(typecode, length):
+    return array(typecode).itemsize * length
+
+
+def save(cache_dir, key, geometry):
+    """
+    Parameters
+    ---------
+    key: tuple
+        from cache_key()
+    geometry: dict
+        flat sequences "virtual_pos", "real_pos", "neighbors" and
+        optionally "dist", "parent", "next_hop"
+    Returns
+    -------
+    path: str or None
+        written file, None on big-endian platforms where nothing is cached
+        or when cache_dir is not writable (with a warning)
+    """
+    if sys.byteorder != "little":
+        return None
+    n_node = len(geometry["virtual_pos"]) // 2
+    has_path_table = geometry.get("dist") is not None
+    payload = []
+    for name, typecode, length in _sections(n_node, has_path_table):
+        data = geometry[name]
+        if not isinstance(data, array) or data.typecode != typecode:
+            data = array(typecode, data)
+        assert len(data) == length, name
+        payload.append(data.tobytes())
+    crc_lattice = 0
+    for chunk in payload[:LATTICE_SECTIONS]:
+        crc_lattice = zlib.crc32(chunk, crc_lattice)
+    crc_table = 0
+    for chunk in payload[LATTICE_SECTIONS:]:
+        crc_table = zlib.crc32(chunk, crc_table)
+    header = HEADER.pack(MAGIC, VERSION, n_node, int(has_path_table), crc_lattice, crc_table,
+                         *key)
+
+    path = cache_path(cache_dir, key)
+    # write to a temporary file and rename, so a reader never sees a partial file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for chunk in payload:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        warnings.warn("geometry cache not written to {}: {}".format(cache_dir, e))
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
+    return path
+
+
+def load(cache_dir, key, need_path_table=True, verify=False):
+    """
+    Parameters
+    ---------
+    verify: bool
+        also check the crc32 of the path table, which reads all of it
+    Returns
+    -------
+    geometry: dict or None
+        memoryviews over the mapped file with the same names as save(),
+        None if there is no valid file for key
+    """
+    path = cache_path(cache_dir, key)
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+    header = HEADER.unpack_from(mm, 0)
+    magic, version, n_node, has_path_table, crc_lattice, crc_table = header[:6]
+    if (magic != MAGIC or version != VERSION or tuple(header[6:]) != key
+            or (need_path_table and not has_path_table)
+            or sys.byteorder != "little"):
+        mm.close()
+        return None
+    sections = _sections(n_node, has_path_table)
+    lattice_end = HEADER.size + sum(_section_size(t, n) for _, t, n in sections[:LATTICE_SECTIONS])
+    expected = HEADER.size + sum(_section_size(t, n) for _, t, n in sections)
+    view = memoryview(mm)
+    if (size != expected or zlib.crc32(view[HEADER.size:lattice_end]) != crc_lattice
+            or (verify and zlib.crc32(view[lattice_end:]) != crc_table)):
+        view.release()
+        mm.close()
+        return None
+
+    geometry = {"mmap": mm}
+    offset = HEADER.size
+    for name, typecode, length in sections:
+        nbytes = _section_size(typecode, length)
+        geometry[name] = view[offset:offset + nbytes].cast(typecode)
+        offset += nbytes
+    return geometry
+
+
+def clear(cache_dir):
+    """remove every cached geometry file in cache_dir"""
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.startswith("geometry_") and name.endswith(".bin"):
+            os.remove(os.path.join(cache_dir, name))
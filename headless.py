@@ -0,0 +1,224 @@
+"""
+Headless batch runner: plays possessions from scenario files without
+pygame, writes one JSON line per possession and reports possessions/sec.
+
+Scenario file (JSON), either one scenario object or {"scenarios": [...]}:
+    {
+        "court": {"rect": [0, 0, 15, 14], "x_offset": 7.5,
+                  "y_offset": 12.425, "factor": 0.9},      (optional)
+        "offense": [[x, y], ...],
+        "defense": [[x, y], ...],
+        "links": [[[x1, y1], [x2, y2]], ...],
+        "ball_agent_id": 0                                   (optional)
+    }
+Positions are virtual (lattice) coordinates, as picked in game.py. A court
+given at the top level applies to every scenario without its own.
+
+    python headless.py plays.json -n 1000 --offense motion -o results.jsonl
+"""
+import sys
+import json
+import time
+import random
+import argparse
+
+import geometry_cache
+from state import State
+from stats import SearchStats
+from strategy import Brownian, Minimax, Oneonone, MotionOffense
+
+# the court game.py draws: Baseline rect and Basket position
+DEFAULT_COURT = {"rect": [0, 0, 15, 14], "x_offset": 7.5, "y_offset": 12.425, "factor": 0.9}
+
+
+def load_scenarios(path):
+    """
+    Returns
+    -------
+    scenarios: list of dict
+        each with "court", "offense", "defense", "links", "ball_agent_id"
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"scenarios": data}
+    court = dict(DEFAULT_COURT, **data.get("court", {}))
+    raw = data["scenarios"] if "scenarios" in data else [data]
+    scenarios = []
+    for i, scenario in enumerate(raw):
+        if len(scenario["offense"]) != len(scenario["defense"]):
+            raise ValueError("scenario {}: offense and defense sizes differ".format(i))
+        scenarios.append({
+            "court": dict(court, **scenario.get("court", {})),
+            "offense": [list(vpos) for vpos in scenario["offense"]],
+            "defense": [list(vpos) for vpos in scenario["defense"]],
+            "links": [[list(v1), list(v2)] for v1, v2 in scenario.get("links", [])],
+            "ball_agent_id": scenario.get("ball_agent_id", 0),
+        })
+    return scenarios
+
+
+def make_state(scenario, cache_dir=None):
+    court = scenario["court"]
+    state = State(court["rect"], court["x_offset"], court["y_offset"],
+                  factor=court["factor"],
+                  n_agent=2 * len(scenario["offense"]),
+                  cache_dir=cache_dir)
+    state.set_agents(scenario["offense"], scenario["defense"], scenario["links"])
+    reset_state(state, scenario)
+    return state
+
+
+def reset_state(state, scenario):
+    """
+    put the agents of state back to the start of scenario, keeping the
+    stand place links so that MotionOffense caches stay valid
+    """
+    state.set_agents(scenario["offense"], scenario["defense"])
+    state.ball_agent_id = scenario["ball_agent_id"]
+    state.screen_one = []
+    state.run_one = []
+    state.log_p = 0
+
+
+def make_strategies(offense, defense, p_screen=0.2, p_unscreen=0.8, seed=0):
+    offense_strategy = {
+        "motion": lambda: MotionOffense(p_screen, p_unscreen),
+        "minimax": lambda: Minimax(seed=seed),
+        "brownian": Brownian,
+    }[offense]()
+    defense_strategy = {
+        "oneonone": Oneonone,
+        "brownian": Brownian,
+        "none": lambda: None,
+    }[defense]()
+    return offense_strategy, defense_strategy
+
+
+def run_possession(state, offense_strategy, defense_strategy, n_step, depth=3):
+    """
+    Play n_step steps from state, in place. Each step the offense moves
+    (one MotionOffense play step, or one move per offense agent), then
+    every defense agent moves; moves onto taken or outside places are
+    skipped.
+
+    Returns
+    -------
+    record: dict
+        moves per step and the final formation
+    """
+    n_offense = int(state.n_agent / 2)
+    steps = []
+    for step in range(n_step):
+        if isinstance(offense_strategy, MotionOffense):
+            move, score = offense_strategy.next_move(state, n_step - step)
+            if move is None:
+                break
+            offense_strategy.apply(state, move)
+            offense_moves = move
+        else:
+            offense_moves = []
+            for agent_id in range(n_offense):
+                if isinstance(offense_strategy, Minimax):
+                    offense_moves.append(offense_strategy.next_move(agent_id, state, depth))
+                else:
+                    offense_moves.append(offense_strategy.next_move(agent_id, state))
+            for agent_id, move in enumerate(offense_moves):
+                state.apply(agent_id, move)
+        defense_moves = []
+        if defense_strategy is not None:
+            for agent_id in range(n_offense, state.n_agent):
+                defense_moves.append(defense_strategy.next_move(agent_id, state))
+            for agent_id, move in zip(range(n_offense, state.n_agent), defense_moves):
+                state.apply(agent_id, move)
+        steps.append({"offense": offense_moves, "defense": defense_moves})
+        if isinstance(offense_strategy, MotionOffense):
+            # score of the play as planned at this step
+            steps[-1]["score"] = score
+
+    return {
+        "steps": steps,
+        "offense": [state.get_agent_virtual_pos(i) for i in range(n_offense)],
+        "defense": [state.get_agent_virtual_pos(i) for i in range(n_offense, state.n_agent)],
+        "ball_agent_id": state.ball_agent_id,
+        "log_p": state.log_p,
+        "open": [i for i in range(n_offense) if state.is_open(i)],
+    }
+
+
+def run_batch(scenarios, n_possession, offense="motion", defense="none", n_step=2,
+              depth=3, p_screen=0.2, p_unscreen=0.8, seed=0, cache_dir=None, stats=None):
+    """
+    Play n_possession possessions, cycling through scenarios. The offense
+    search records into stats, a stats.SearchStats, if given.
+
+    Yields
+    ------
+    record: dict
+        run_possession() record with "possession" and "scenario" indexes
+    """
+    random.seed(seed)
+    states = {}
+    offense_strategy, defense_strategy = make_strategies(
+        offense, defense, p_screen, p_unscreen, seed)
+    offense_strategy.set_stats(stats)
+    for k in range(n_possession):
+        i = k % len(scenarios)
+        if i not in states:
+            states[i] = make_state(scenarios[i], cache_dir)
+        else:
+            reset_state(states[i], scenarios[i])
+        record = run_possession(states[i], offense_strategy, defense_strategy, n_step, depth)
+        record["possession"] = k
+        record["scenario"] = i
+        yield record
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Headless basketball simulator batch runner")
+    parser.add_argument("scenario", help="scenario JSON file")
+    parser.add_argument("-n", "--n_possession", type=int, default=1,
+                        help="number of possessions, cycling through the scenarios")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSON lines result file, - for stdout")
+    parser.add_argument("--offense", choices=["motion", "minimax", "brownian"], default="motion")
+    parser.add_argument("--defense", choices=["none", "oneonone", "brownian"], default="none")
+    parser.add_argument("--time_step", type=int, default=2,
+                        help="steps per possession")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Minimax search depth")
+    parser.add_argument("--p_screen", type=float, default=0.2)
+    parser.add_argument("--p_unscreen", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache_dir", default=geometry_cache.DEFAULT_CACHE_DIR,
+                        help="court geometry cache directory, '' to disable")
+    parser.add_argument("--stats", default="",
+                        help="write the offense search statistics as JSON to this file")
+    parser.add_argument("--trace", default="",
+                        help="write a Chrome trace of the offense search to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    scenarios = load_scenarios(args.scenario)
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    stats = None
+    if args.stats or args.trace:
+        stats = SearchStats(trace=bool(args.trace))
+    start = time.perf_counter()
+    n = 0
+    for record in run_batch(scenarios, args.n_possession, args.offense, args.defense,
+                            args.time_step, args.depth, args.p_screen, args.p_unscreen,
+                            args.seed, args.cache_dir or None, stats):
+        out.write(json.dumps(record) + "\n")
+        n += 1
+    elapsed = time.perf_counter() - start
+    if out is not sys.stdout:
+        out.close()
+    if args.stats:
+        stats.write_json(args.stats)
+    if args.trace:
+        stats.write_chrome_trace(args.trace)
+    print("{} possessions in {:.3f} s, {:.1f} possessions/s".format(
+        n, elapsed, n / elapsed if elapsed > 0 else float("inf")), file=sys.stderr)
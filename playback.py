@@ -0,0 +1,170 @@
+"""
+Animated playback of a MotionOffense play.
+
+SearchWorker searches the play step by step in a background thread on its
+own copy of the state, so the window keeps drawing and handling events
+while a deep search runs. play() animates every step as soon as it is
+found: moving agents walk along Position.get_shortest_path between
+lattice places at a fixed frame rate, a pass is drawn as the ball flying
+from passer to receiver and screening agents get a ring.
+"""
+import sys
+import copy
+import queue
+import threading
+
+import pygame
+from pygame.locals import QUIT, VIDEOEXPOSE
+
+BALL_COLOR = (255, 140, 0)
+SCREEN_COLOR = (255, 200, 0)
+# posted by SearchWorker for every result, wakes a loop blocked in pygame.event.wait
+SEARCH_EVENT = pygame.event.custom_type()
+
+
+class SearchWorker(threading.Thread):
+    """
+    Runs the play of offense from state for time_step steps and puts
+    (move, log_p) of every step into self.results as soon as it is found,
+    then None. With a pygame display every result also posts a
+    SEARCH_EVENT.
+    """
+    def __init__(self, offense, state, time_step):
+        super().__init__(daemon=True)
+        self.offense = offense
+        self.state = copy.copy(state)
+        self.state.my_deep_copy()
+        self.time_step = time_step
+        self.results = queue.Queue()
+
+    def run(self):
+        time_step = self.time_step
+        while time_step > 0:
+            move, log_p = self.offense.next_move(self.state, time_step)
+            self.put((move, log_p))
+            if move is None:
+                break
+            self.offense.apply(self.state, move)
+            time_step -= 1
+        self.put(None)
+
+    def put(self, result):
+        self.results.put(result)
+        if pygame.display.get_init():
+            pygame.event.post(pygame.event.Event(SEARCH_EVENT))
+
+
+def step_paths(state, move):
+    """
+    Returns
+    -------
+    paths: dict
+        agent_id -> real coordinates of the lattice places it walks
+        through in this step, only for agents that move
+    """
+    targets = {}
+    for agent_id_1, agent_id_2 in move["screen"].items():
+        targets[agent_id_1] = state.get_agent_virtual_pos(agent_id_2)
+    for agent_id, vpos in move["go"].items():
+        targets[agent_id] = vpos
+    paths = {}
+    for agent_id, vpos in targets.items():
+        path = state.get_shortest_path(state.get_agent_virtual_pos(agent_id), vpos)
+        paths[agent_id] = [state.position.virtual_to_real(x) for x in path]
+    return paths
+
+
+def interpolate(path, f):
+    """point at fraction f of a path of equally long lattice edges"""
+    t = f * (len(path) - 1)
+    i = min(int(t), len(path) - 2)
+    if i < 0:
+        return list(path[0])
+    frac = t - i
+    return [path[i][0] + (path[i + 1][0] - path[i][0]) * frac,
+            path[i][1] + (path[i + 1][1] - path[i][1]) * frac]
+
+
+def frame_sprites(game, palette, state, paths=None, move=None, f=0.):
+    """
+    sprites of state with the moving agents at fraction f of their paths:
+    screen rings, agents, and the ball while it is passed
+    """
+    real_pos = [state.position.virtual_to_real(agent.get_virtual_pos())
+                for agent in state.agents]
+    for agent_id, path in (paths or {}).items():
+        real_pos[agent_id] = interpolate(path, f)
+    agents = state.agent_sprites(palette, game.court_x_offset, game.court_y_offset,
+                                 game.court_factor, real_pos)
+
+    sprites = {}
+    screeners = state.screen_one if move is None else list(move["screen"])
+    for text, x, y, r_agent, _, _ in agents:
+        if int(text) in screeners:
+            sprites["screen " + text] = ("screen " + text, x, y, r_agent + 4, (SCREEN_COLOR,), None)
+    for sprite in agents:
+        sprites[sprite[0]] = sprite
+    if move is not None and len(move["pass"]) > 0 and f < 1:
+        passer, receiver = next(iter(move["pass"].items()))
+        a = real_pos[passer]
+        b = real_pos[receiver]
+        x = int((a[0] + (b[0] - a[0]) * f) * game.court_factor + game.court_x_offset)
+        y = int((a[1] + (b[1] - a[1]) * f) * game.court_factor + game.court_y_offset)
+        sprites["ball"] = ("ball", x, y, 6, (BALL_COLOR,), None)
+    return sprites
+
+
+def handle_event(event):
+    if event.type == QUIT:
+        pygame.quit()
+        sys.exit()
+    elif event.type == VIDEOEXPOSE:
+        pygame.display.update()
+
+
+def handle_events():
+    for event in pygame.event.get():
+        handle_event(event)
+
+
+def animate_step(game, palette, court_lines, state, move, fps=30, step_time=1.):
+    """draw state walking through move, state itself is not changed"""
+    clock = pygame.time.Clock()
+    paths = step_paths(state, move)
+    n_frame = max(1, int(step_time * fps))
+    for k in range(1, n_frame + 1):
+        handle_events()
+        sprites = frame_sprites(game, palette, state, paths, move, k / n_frame)
+        game.draw_sprites(palette, court_lines, state, sprites)
+        clock.tick(fps)
+
+
+def play(game, palette, court_lines, state, offense, time_step, fps=30, step_time=1.):
+    """
+    Search the play of offense in a SearchWorker and animate each step
+    as it arrives. While waiting for the search the loop sleeps in
+    pygame.event.wait until a SEARCH_EVENT or user input comes in.
+
+    Returns
+    -------
+    moves: list of (move, log_p)
+        state is left at the end of the play
+    """
+    worker = SearchWorker(offense, state, time_step)
+    worker.start()
+    game.draw_sprites(palette, court_lines, state, frame_sprites(game, palette, state))
+    moves = []
+    while True:
+        try:
+            result = worker.results.get_nowait()
+        except queue.Empty:
+            handle_event(pygame.event.wait())
+            continue
+        if result is None or result[0] is None:
+            break
+        move, log_p = result
+        moves.append(result)
+        animate_step(game, palette, court_lines, state, move, fps, step_time)
+        offense.apply(state, move)
+        game.draw_sprites(palette, court_lines, state, frame_sprites(game, palette, state))
+    return moves
@@ -0,0 +1,223 @@
+"""
+Monte Carlo rollouts of a MotionOffense play.
+
+MotionOffense scores a play by log_p: every step, each agent that goes to
+a place linked with the ball holder adds log(p) of its defender catching
+up, p_screen if the agent was screened for in the step before (run_one),
+else p_unscreen. Here those catch-ups are sampled instead: a defender
+that fails to catch up leaves its agent open and the possession ends
+there with an open shot. When several agents get open in the same step
+the ball goes to one of them at random.
+
+All rollouts of a chunk are sampled at once with NumPy random arrays;
+chunks have their own seeds spawned from one SeedSequence, so results
+only depend on seed and n_rollout, also with a process pool.
+
+    python rollout.py plays.json -n 1000000 --time_step 4 --jobs 4
+"""
+import sys
+import copy
+import math
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import geometry_cache
+import headless
+from strategy import MotionOffense
+
+CHUNK_SIZE = 100000
+
+
+def plan_play(offense, state, time_step):
+    """
+    Moves of the play offense picks from state, one next_move per step
+    as the game plays it; state is not changed.
+
+    Returns
+    -------
+    moves: list of move
+    """
+    work = copy.copy(state)
+    work.my_deep_copy()
+    moves = []
+    while time_step > 0:
+        move, _ = offense.next_move(work, time_step)
+        if move is None:
+            break
+        moves.append(move)
+        offense.apply(work, move)
+        time_step -= 1
+    return moves
+
+
+def compile_play(offense, state, moves):
+    """
+    Catch-up events of a play, in the order of get_reward.
+
+    Returns
+    -------
+    events: dict
+        "step", "agent": int arrays (n_event,), "p": float array (n_event,)
+        of catch-up probabilities, "n_step", and "log_p", their sum of
+        log(p) as get_reward adds it up
+    """
+    work = copy.copy(state)
+    work.my_deep_copy()
+    steps = []
+    agents = []
+    ps = []
+    log_p = 0.
+    for step, move in enumerate(moves):
+        ball_agent_id = work.ball_agent_id
+        for x in move["pass"]:  # only one x
+            ball_agent_id = move["pass"][x]
+        n1 = work.get_agent_node(ball_agent_id)
+        for agent_id in move["go"]:
+            n2 = work.position.node_id(move["go"][agent_id])
+            if work.is_linked(n1, n2):
+                p = offense.p_screen if agent_id in work.run_one else offense.p_unscreen
+                steps.append(step)
+                agents.append(agent_id)
+                ps.append(p)
+                log_p += math.log(p)
+        offense.apply(work, move)
+    return {"step": np.array(steps, dtype=np.int64), "agent": np.array(agents, dtype=np.int64),
+            "p": np.array(ps, dtype=float), "n_step": len(moves), "log_p": log_p}
+
+
+def sample(events, n_rollout, rng):
+    """
+    Parameters
+    ---------
+    events: dict
+        from compile_play()
+    rng: numpy.random.Generator
+    Returns
+    -------
+    open_agent: int array (n_rollout,)
+        agent that got open, -1 if every defender caught up
+    open_step: int array (n_rollout,)
+        step it got open in, -1 if none
+    """
+    step = events["step"]
+    n_event = len(step)
+    if n_event == 0:
+        return np.full(n_rollout, -1), np.full(n_rollout, -1)
+    failed = rng.random((n_rollout, n_event)) >= events["p"]
+    # earliest step with an open agent: events are in step order, so the
+    # first failed event has it
+    first = failed.argmax(axis=1)
+    any_open = failed[np.arange(n_rollout), first]
+    open_step = np.where(any_open, step[first], -1)
+    # one of the open agents of that step at random
+    candidate = failed & (step == open_step[:, None])
+    priority = np.where(candidate, rng.random((n_rollout, n_event)), -1.)
+    open_agent = np.where(any_open, events["agent"][priority.argmax(axis=1)], -1)
+    return open_agent, open_step
+
+
+def _count_chunk(task):
+    """per agent and per step counts of open rollouts of one chunk"""
+    events, n_rollout, seed, n_agent = task
+    rng = np.random.default_rng(seed)
+    open_agent, open_step = sample(events, n_rollout, rng)
+    by_agent = np.bincount(open_agent[open_agent >= 0], minlength=n_agent)
+    by_step = np.bincount(open_step[open_step >= 0], minlength=max(events["n_step"], 1))
+    return by_agent, by_step
+
+
+def wilson_interval(k, n, z=1.96):
+    """confidence interval of a binomial proportion k / n, Wilson score"""
+    if n == 0:
+        return 0., 1.
+    p = k / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0., center - half), min(1., center + half)
+
+
+def rollout(events, n_rollout, n_agent, seed=0, n_jobs=1, z=1.96, chunk_size=CHUNK_SIZE):
+    """
+    Sample n_rollout possessions of a compiled play.
+
+    Parameters
+    ---------
+    n_agent: int
+        offense agents, the length of the per agent results
+    n_jobs: int
+        > 1 samples the chunks in a pool of n_jobs processes, with the
+        same result
+    z: float
+        normal quantile of the confidence intervals, 1.96 for 95 %
+    Returns
+    -------
+    result: dict
+        "p_open" with its "ci", "open_by_agent" and "open_by_step" lists
+        of {"p", "ci"}, "p_defended" and "p_defended_exact", the
+        probability that every defender catches up, exp(log_p)
+    """
+    sizes = [chunk_size] * (n_rollout // chunk_size)
+    if n_rollout % chunk_size:
+        sizes.append(n_rollout % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(events, size, chunk_seed, n_agent) for size, chunk_seed in zip(sizes, seeds)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            counts = list(pool.map(_count_chunk, tasks))
+    else:
+        counts = [_count_chunk(task) for task in tasks]
+
+    by_agent = sum(c[0] for c in counts) if counts else np.zeros(n_agent, dtype=np.int64)
+    by_step = sum(c[1] for c in counts) if counts else np.zeros(1, dtype=np.int64)
+    n_open = int(by_agent.sum())
+
+    def share(k):
+        return {"p": k / n_rollout if n_rollout else 0., "ci": wilson_interval(k, n_rollout, z)}
+
+    return {
+        "n_rollout": n_rollout,
+        "p_open": n_open / n_rollout if n_rollout else 0.,
+        "ci": wilson_interval(n_open, n_rollout, z),
+        "open_by_agent": [share(int(k)) for k in by_agent],
+        "open_by_step": [share(int(k)) for k in by_step[:events["n_step"]]],
+        "p_defended": 1 - n_open / n_rollout if n_rollout else 1.,
+        "p_defended_exact": math.exp(events["log_p"]),
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Monte Carlo rollouts of MotionOffense plays")
+    parser.add_argument("scenario", help="scenario JSON file, see headless.py")
+    parser.add_argument("-n", "--n_rollout", type=int, default=1000000)
+    parser.add_argument("--time_step", type=int, default=4,
+                        help="steps of the searched play")
+    parser.add_argument("--search", choices=["exhaustive", "bounded", "beam"], default="bounded")
+    parser.add_argument("--p_screen", type=float, default=0.2)
+    parser.add_argument("--p_unscreen", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--cache_dir", default=geometry_cache.DEFAULT_CACHE_DIR,
+                        help="court geometry cache directory, '' to disable")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    offense = MotionOffense(args.p_screen, args.p_unscreen, search=args.search)
+    for i, scenario in enumerate(headless.load_scenarios(args.scenario)):
+        state = headless.make_state(scenario, args.cache_dir or None)
+        moves = plan_play(offense, state, args.time_step)
+        events = compile_play(offense, state, moves)
+        start = time.perf_counter()
+        result = rollout(events, args.n_rollout, len(scenario["offense"]), args.seed, args.jobs)
+        elapsed = time.perf_counter() - start
+        result["scenario"] = i
+        result["moves"] = moves
+        print(json.dumps(result))
+        print("scenario {}: {} rollouts in {:.3f} s".format(i, args.n_rollout, elapsed),
+              file=sys.stderr)
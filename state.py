@@ -1,10 +1,23 @@
 import math
 import random
-import pygame
 import copy
+import struct
+from array import array
+from collections import deque, OrderedDict
+
+import geometry_cache
+
+# largest court that gets the all-pairs path table by default: the table
+# takes 3 * n_node ** 2 ints and n_node BFS to build (about 2 MB and 0.2 s
+# here), larger courts use the BFS rows of path_row, which give the same paths
+PATH_TABLE_MAX_NODE = 400
 
 class Position:
-    def __init__(self, rect, x_offset, y_offset, factor=1):
+    legal_moves = [[0, -2], [1, -1], [1, 1],
+                   [0, 2], [-1, 1], [-1, -1]]
+
+    def __init__(self, rect, x_offset, y_offset, factor=1, path_table=None, cache_dir=None,
+                 row_cache_size=256):
         """
         Parameters
         ---------
@@ -16,40 +29,237 @@ class Position:
             start point y
         factor: int
             factor of edge of six-direction
+        path_table: bool or None
+            precompute all-pairs distance / next-hop table; None builds
+            it only for courts up to PATH_TABLE_MAX_NODE nodes
+        cache_dir: str or None
+            load / store the built geometry in this directory,
+            see geometry_cache
+        row_cache_size: int
+            without the table, BFS rows kept for node_path, node_distance
+            and node_next_hop
         """
         self.rect = rect
         self.x_offset = x_offset
         self.y_offset = y_offset
         self.factor = factor
+        self.cache_dir = cache_dir
+        self._dist = None
+        self._parent = None
+        self._next_hop = None
+        self._mmap = None
+        self._rows = OrderedDict()  # source node -> (dist, parent, next_hop)
+        self.row_cache_size = row_cache_size
+
+        key = geometry_cache.cache_key(rect, x_offset, y_offset, factor)
+        self.key = key
+        geometry = None
+        if cache_dir is not None:
+            geometry = geometry_cache.load(cache_dir, key, path_table is True)
+        if geometry is not None:
+            self.set_geometry(geometry)
+            if self._dist is not None or not self.want_path_table(path_table):
+                return
+            self.build_path_table()
+        else:
+            self.virtual_pos = self.build_lattice()  # store int coordinate
+            self.build_index()
+            if self.want_path_table(path_table):
+                self.build_path_table()
+        if cache_dir is not None:
+            geometry_cache.save(cache_dir, key, self.get_geometry())
+
+    def want_path_table(self, path_table):
+        if path_table is None:
+            return self.n_node <= PATH_TABLE_MAX_NODE
+        return bool(path_table)
 
-        def dfs(x, y, pos):
-            if ([x, y+2] not in pos and
-                    self.virtual_is_in([x, y+2])):
-                pos.append([x, y+2])
-                dfs(x, y+2, pos)
-            if ([x, y-2] not in pos and
-                    self.virtual_is_in([x, y-2])):
-                pos.append([x, y-2])
-                dfs(x, y-2, pos)
-            if ([x+1, y-1] not in pos and
-                    self.virtual_is_in([x+1, y-1])):
-                pos.append([x+1, y-1])
-                dfs(x+1, y-1, pos)
-            if ([x+1, y+1] not in pos and
-                    self.virtual_is_in([x+1, y+1])):
-                pos.append([x+1, y+1])
-                dfs(x+1, y+1, pos)
-            if ([x-1, y+1] not in pos and
-                    self.virtual_is_in([x-1, y+1])):
-                pos.append([x-1, y+1])
-                dfs(x-1, y+1, pos)
-            if ([x-1, y-1] not in pos and
-                    self.virtual_is_in([x-1, y-1])):
-                pos.append([x-1, y-1])
-                dfs(x-1, y-1, pos)
-
-        self.virtual_pos = []  # store int coordinate
-        dfs(0, 0, self.virtual_pos)
+    def build_index(self):
+        """node ids, real coordinates and neighbor lists of self.virtual_pos"""
+        # node id of a lattice position is its index in self.virtual_pos
+        self.n_node = len(self.virtual_pos)
+        self._node_id = {}
+        for i, vpos in enumerate(self.virtual_pos):
+            self._node_id[(vpos[0], vpos[1])] = i
+        self.real_pos = [self.virtual_to_real(vpos) for vpos in self.virtual_pos]
+        self.neighbors = []
+        for vpos in self.virtual_pos:
+            ids = []
+            for legal_move in self.legal_moves:
+                key = (vpos[0] + legal_move[0], vpos[1] + legal_move[1])
+                if key in self._node_id:
+                    ids.append(self._node_id[key])
+            self.neighbors.append(ids)
+
+    def get_geometry(self):
+        """flat arrays of the built geometry, the format of geometry_cache.save"""
+        geometry = {"virtual_pos": array("i"), "real_pos": array("d"),
+                    "neighbors": array("i")}
+        for vpos, rpos, ids in zip(self.virtual_pos, self.real_pos, self.neighbors):
+            geometry["virtual_pos"].extend(vpos)
+            geometry["real_pos"].extend(rpos)
+            geometry["neighbors"].extend(ids + [-1] * (geometry_cache.MAX_NEIGHBOR - len(ids)))
+        geometry["dist"] = self._dist
+        geometry["parent"] = self._parent
+        geometry["next_hop"] = self._next_hop
+        return geometry
+
+    def set_geometry(self, geometry):
+        """adopt geometry loaded by geometry_cache.load, tables stay memory-mapped"""
+        n = len(geometry["virtual_pos"]) // 2
+        flat_vpos = geometry["virtual_pos"].tolist()
+        flat_rpos = geometry["real_pos"].tolist()
+        flat_neighbors = geometry["neighbors"].tolist()
+        self.n_node = n
+        self.virtual_pos = [flat_vpos[2 * i:2 * i + 2] for i in range(n)]
+        self.real_pos = [flat_rpos[2 * i:2 * i + 2] for i in range(n)]
+        self.neighbors = []
+        for i in range(n):
+            row = flat_neighbors[geometry_cache.MAX_NEIGHBOR * i:geometry_cache.MAX_NEIGHBOR * (i + 1)]
+            self.neighbors.append([x for x in row if x >= 0])
+        self._node_id = {}
+        for i, vpos in enumerate(self.virtual_pos):
+            self._node_id[(vpos[0], vpos[1])] = i
+        self._dist = geometry.get("dist")
+        self._parent = geometry.get("parent")
+        self._next_hop = geometry.get("next_hop")
+        self._mmap = geometry["mmap"]
+
+    def __getstate__(self):
+        """
+        memory-mapped tables can't be pickled: they are left out and mapped
+        again from the cache file by __setstate__
+        """
+        attrs = self.__dict__.copy()
+        if self._mmap is not None:
+            attrs["_mmap"] = None
+            attrs["_remap"] = self._dist is not None
+            attrs["_dist"] = attrs["_parent"] = attrs["_next_hop"] = None
+        return attrs
+
+    def __setstate__(self, attrs):
+        remap = attrs.pop("_remap", False)
+        self.__dict__.update(attrs)
+        if not remap:
+            return
+        geometry = geometry_cache.load(self.cache_dir, self.key)
+        if geometry is None:
+            # the cache file is gone, build the table again
+            self.build_path_table()
+            return
+        self._dist = geometry["dist"]
+        self._parent = geometry["parent"]
+        self._next_hop = geometry["next_hop"]
+        self._mmap = geometry["mmap"]
+
+    # expansion order of the lattice flood fill, kept from the old recursive dfs
+    lattice_moves = [[0, 2], [0, -2], [1, -1],
+                     [1, 1], [-1, 1], [-1, -1]]
+
+    def build_lattice(self):
+        """
+        Flood fill the lattice from [0, 0] with an explicit stack and a set
+        of visited coordinates. Nodes come out in the same depth-first
+        preorder as the old recursive builder, so node ids are unchanged,
+        but the cost is linear and deep fills don't hit the recursion limit.
+
+        Returns
+        -------
+        virtual_pos: list of [x, y]
+            lattice nodes inside rect
+        """
+        moves = self.lattice_moves
+        n_move = len(moves)
+        pos = []
+        seen = set()
+        stack = [[0, 0, 0]]  # x, y, index of next move to try
+        while stack:
+            top = stack[-1]
+            if top[2] == n_move:
+                stack.pop()
+                continue
+            move = moves[top[2]]
+            top[2] += 1
+            key = (top[0] + move[0], top[1] + move[1])
+            if key in seen:
+                continue
+            seen.add(key)
+            if not self.virtual_is_in(key):
+                continue
+            pos.append([key[0], key[1]])
+            stack.append([key[0], key[1], 0])
+        return pos
+
+    def node_id(self, virtual_pos):
+        """
+        Returns
+        -------
+        node: int or None
+            dense id of virtual_pos, None if it is not a lattice node
+        """
+        return self._node_id.get((virtual_pos[0], virtual_pos[1]))
+
+    def node_vpos(self, node):
+        """virtual position of node id, shared with self.virtual_pos"""
+        return self.virtual_pos[node]
+
+    def build_path_table(self):
+        """
+        BFS from every lattice node, stored as flat arrays of n * n
+        indexed by source * n + target:
+            _dist: number of edges on the shortest path
+            _parent: node before target on the path from source
+            _next_hop: node after source on the path to target
+        Neighbors are visited in the same order as the old per-call BFS,
+        so the stored paths are the same ones get_shortest_path returned.
+        """
+        n = self.n_node
+        dist = array("i", [-1]) * (n * n)
+        parent = array("i", [-1]) * (n * n)
+        next_hop = array("i", [-1]) * (n * n)
+        for source in range(n):
+            self._bfs_row(source, dist, parent, next_hop, source * n)
+        self._dist = dist
+        self._parent = parent
+        self._next_hop = next_hop
+        self._rows.clear()
+
+    def _bfs_row(self, source, dist, parent, next_hop, row):
+        """BFS from source into the arrays at offset row, see build_path_table"""
+        neighbors = self.neighbors
+        dist[row + source] = 0
+        for x in neighbors[source]:
+            dist[row + x] = 1
+            parent[row + x] = source
+            next_hop[row + x] = x
+        queue = deque(neighbors[source])
+        while queue:
+            x = queue.popleft()
+            d = dist[row + x] + 1
+            hop = next_hop[row + x]
+            for y in neighbors[x]:
+                if dist[row + y] < 0:
+                    dist[row + y] = d
+                    parent[row + y] = x
+                    next_hop[row + y] = hop
+                    queue.append(y)
+
+    def path_row(self, source):
+        """
+        (dist, parent, next_hop) arrays of n_node from source, the
+        build_path_table row computed on demand when there is no table
+        """
+        row = self._rows.get(source)
+        if row is not None:
+            self._rows.move_to_end(source)
+            return row
+        n = self.n_node
+        row = (array("i", [-1]) * n, array("i", [-1]) * n, array("i", [-1]) * n)
+        self._bfs_row(source, row[0], row[1], row[2], 0)
+        self._rows[source] = row
+        if len(self._rows) > self.row_cache_size:
+            self._rows.popitem(last=False)
+        return row
 
     def virtual_is_in(self, virtual_pos):
         """test if virtual_pos in rect"""
@@ -67,40 +277,178 @@ class Position:
         real_y = virtual_pos[1] / 2 * self.factor + self.y_offset
         return [real_x, real_y]
 
+    def real_to_virtual(self, real_pos):
+        """
+        inverse of virtual_to_real, fractional virtual coordinates of
+        real_pos
+        """
+        return [(real_pos[0] - self.x_offset) / (math.sqrt(3) / 2 * self.factor),
+                (real_pos[1] - self.y_offset) / (self.factor / 2)]
+
+    def nearest_node(self, real_pos, radius=None):
+        """
+        Nearest lattice node to a real position in O(1): the lattice is
+        the union of two rectangular lattices (x, y both even / both odd),
+        and the nearest point of a rectangular lattice is found by rounding
+        each coordinate. Only if that point is outside the court are the
+        lattice points within radius searched.
+
+        Parameters
+        ---------
+        real_pos: [x, y]
+        radius: float or None
+            only nodes closer than radius count, None for no limit
+        Returns
+        -------
+        node: int or None
+            node id, None if no node is closer than radius
+        """
+        u, v = self.real_to_virtual(real_pos)
+        best = None
+        for parity in (0, 1):
+            key = (2 * round((u - parity) / 2) + parity, 2 * round((v - parity) / 2) + parity)
+            d = self._real_distance_to(key, real_pos)
+            if best is None or d < best[0]:
+                best = (d, key)
+        d, key = best
+        if radius is not None and d >= radius:
+            return None
+        node = self._node_id.get(key)
+        if node is not None:
+            return node
+        # the nearest lattice point is off the court: scan the lattice
+        # points around real_pos, within radius or up to the court
+        return self._nearest_node_scan(u, v, real_pos, radius)
+
+    def _real_distance_to(self, virtual_pos, real_pos):
+        rpos = self.virtual_to_real(virtual_pos)
+        return pow(pow(rpos[0] - real_pos[0], 2) + pow(rpos[1] - real_pos[1], 2), 0.5)
+
+    def _nearest_node_scan(self, u, v, real_pos, radius):
+        if radius is None:
+            best = None
+            for node, rpos in enumerate(self.real_pos):
+                d = pow(pow(rpos[0] - real_pos[0], 2) + pow(rpos[1] - real_pos[1], 2), 0.5)
+                if best is None or d < best[0]:
+                    best = (d, node)
+            return None if best is None else best[1]
+        du = radius / (math.sqrt(3) / 2 * self.factor)
+        dv = radius / (self.factor / 2)
+        best = None
+        for x in range(math.floor(u - du), math.ceil(u + du) + 1):
+            y_min = math.floor(v - dv)
+            for y in range(y_min + (y_min + x) % 2, math.ceil(v + dv) + 1, 2):
+                node = self._node_id.get((x, y))
+                if node is None:
+                    continue
+                d = self._real_distance_to((x, y), real_pos)
+                if d < radius and (best is None or d < best[0]):
+                    best = (d, node)
+        return None if best is None else best[1]
+
+    def nearest_nodes(self, real_positions, radius=None):
+        """nearest_node() of many real positions, list of node ids or None"""
+        return [self.nearest_node(real_pos, radius) for real_pos in real_positions]
+
     def get_real_pos(self):
-        real_pos = []
-        for pos in self.virtual_pos:
-            real_pos.append(self.virtual_to_real(pos))
-        return real_pos
+        return self.real_pos
 
     def get_real_distance(self):
         return self.factor
 
     def get_shortest_path(self, a, b):
-        legal_moves = [[0, -2], [1, -1], [1, 1],
-                       [0, 2], [-1, 1], [-1, -1]]
+        ia = self.node_id(a)
+        ib = self.node_id(b)
+        if ia is None or ib is None:
+            return self._bfs_shortest_path(a, b)
+        return [list(self.virtual_pos[x]) for x in self.node_path(ia, ib)]
+
+    def node_path(self, ia, ib):
+        """shortest path between two node ids as a list of node ids"""
+        if self._dist is None:
+            dist, parent, _ = self.path_row(ia)
+            row = 0
+        else:
+            dist = self._dist
+            parent = self._parent
+            row = ia * self.n_node
+        if dist[row + ib] < 0:
+            raise KeyError(str(self.virtual_pos[ib]))
+        path = [ib]
+        cur = ib
+        while cur != ia:
+            cur = parent[row + cur]
+            path.append(cur)
+        return path[::-1]
+
+    def next_hop(self, a, b):
+        """
+        Returns
+        -------
+        vpos: [x, y] or None
+            next position on the shortest path from a to b,
+            None if a == b
+        """
+        ia = self.node_id(a)
+        ib = self.node_id(b)
+        if ia is None or ib is None:
+            path = self._bfs_shortest_path(a, b)
+            return path[1] if len(path) > 1 else None
+        hop = self.node_next_hop(ia, ib)
+        if hop is None:
+            return None
+        return list(self.virtual_pos[hop])
+
+    def node_next_hop(self, ia, ib):
+        """next node id on the path from ia to ib, None if ia == ib"""
+        if ia == ib:
+            return None
+        if self._dist is None:
+            hop = self.path_row(ia)[2][ib]
+        else:
+            hop = self._next_hop[ia * self.n_node + ib]
+        if hop < 0:
+            raise KeyError(str(self.virtual_pos[ib]))
+        return hop
+
+    def node_distance(self, ia, ib):
+        """number of edges between two node ids"""
+        if self._dist is None:
+            d = self.path_row(ia)[0][ib]
+        else:
+            d = self._dist[ia * self.n_node + ib]
+        if d < 0:
+            raise KeyError(str(self.virtual_pos[ib]))
+        return d
+
+    def _bfs_shortest_path(self, a, b):
+        """single-source BFS, used for positions outside the table"""
         check_list = {}
-        queue = [a]
-        check_list[str(a)] = None
+        queue = deque([a])
+        check_list[(a[0], a[1])] = None
 
         while len(queue) > 0:
-            x = queue[0]
-            queue = queue[1:]
-            for legal_move in legal_moves:
+            x = queue.popleft()
+            for legal_move in self.legal_moves:
                 new_x = [x[0] + legal_move[0], x[1] + legal_move[1]]
-                if new_x in self.virtual_pos and str(new_x) not in check_list:
-                    check_list[str(new_x)] = x
+                key = (new_x[0], new_x[1])
+                if key in self._node_id and key not in check_list:
+                    check_list[key] = x
                     queue.append(new_x)
 
         path = [b]
         cur = b
         while a not in path:
-            path.append(check_list[str(cur)])
-            cur = check_list[str(cur)]
+            cur = check_list[(cur[0], cur[1])]
+            path.append(cur)
         return path[::-1]
 
     def virtual_distance(self, a, b):
-        return len(self.get_shortest_path(a, b))
+        ia = self.node_id(a)
+        ib = self.node_id(b)
+        if ia is None or ib is None:
+            return len(self.get_shortest_path(a, b))
+        return self.node_distance(ia, ib) + 1
 
     def real_distance(self, a, b):
         real_a = self.virtual_to_real(a)
@@ -110,11 +458,23 @@ class Position:
         return pow(pow(diff_x, 2) + pow(diff_y, 2), 0.5)
 
 class Agent:
-    def __init__(self, virtual_pos):
+    __slots__ = ("virtual_pos", "node")
+
+    def __init__(self, virtual_pos, node=None):
+        """
+        Parameters
+        ---------
+        virtual_pos: [x, y]
+            lattice coordinate
+        node: int or None
+            node id of virtual_pos, resolved by State when None
+        """
         self.virtual_pos = virtual_pos
+        self.node = node
 
-    def set_vpos(self, vpos):
+    def set_vpos(self, vpos, node=None):
         self.virtual_pos = vpos
+        self.node = node
 
     def new_virtual_pos(self, virtual_pos_diff):
         return [self.virtual_pos[0] + virtual_pos_diff[0],
@@ -122,13 +482,103 @@ class Agent:
 
     def move(self, virtual_pos_diff):
         self.virtual_pos = self.new_virtual_pos(virtual_pos_diff)
+        self.node = None
 
     def get_virtual_pos(self):
         return self.virtual_pos
 
 
+class RenderCache:
+    """
+    pygame fonts per size and rendered text per (text, color, size), so
+    that drawing a frame neither opens fonts nor renders agent numbers.
+    One instance is shared by every State and its copies (State.render_cache).
+    """
+    def __init__(self):
+        self.fonts = {}
+        self.glyphs = {}
+
+    def font(self, size=24):
+        if size not in self.fonts:
+            import pygame
+            self.fonts[size] = pygame.font.Font(None, size)
+        return self.fonts[size]
+
+    def glyph(self, text, color, size=24):
+        key = (text, color, size)
+        if key not in self.glyphs:
+            self.glyphs[key] = self.font(size).render(text, 1, color)
+        return self.glyphs[key]
+
+    def clear(self):
+        """drop every font and glyph, needed after pygame.quit()"""
+        self.fonts.clear()
+        self.glyphs.clear()
+
+
+class CompactState(bytes):
+    """
+    Hashable snapshot of the changing part of a State, packed into one
+    bytes object: width of a node id, node id per agent (uint16, uint32 on
+    courts of more than 65535 nodes), ball holder, bit masks of
+    screen_one / run_one and log_p. Equality and hash are those of bytes.
+
+    screen_one is restored in ascending order, which is the order the
+    MotionOffense move generator produces, and run_one order is never
+    used, so the bit masks lose nothing a search depends on.
+    """
+    __slots__ = ()
+    _structs = {}
+
+    @classmethod
+    def _struct(cls, n_agent, width=2):
+        if (n_agent, width) not in cls._structs:
+            cls._structs[(n_agent, width)] = struct.Struct(
+                "<B{}{}bHHd".format(n_agent, "H" if width == 2 else "I"))
+        return cls._structs[(n_agent, width)]
+
+    @classmethod
+    def pack(cls, nodes, ball_agent_id, screen_mask, run_mask, log_p, n_node=0):
+        """n_node: nodes of the court, decides the width of the node ids"""
+        if ball_agent_id is None:
+            ball_agent_id = -1
+        width = 2 if n_node <= 0x10000 else 4
+        return cls(cls._struct(len(nodes), width).pack(width, *nodes, ball_agent_id,
+                                                        screen_mask, run_mask, log_p))
+
+    @property
+    def n_agent(self):
+        return (len(self) - 14) // self[0]
+
+    def unpack(self):
+        """
+        Returns
+        -------
+        nodes, ball_agent_id, screen_mask, run_mask, log_p
+        """
+        n_agent = self.n_agent
+        values = self._struct(n_agent, self[0]).unpack(self)[1:]
+        ball_agent_id = values[n_agent] if values[n_agent] >= 0 else None
+        return values[:n_agent], ball_agent_id, values[n_agent + 1], values[n_agent + 2], values[n_agent + 3]
+
+    @property
+    def nodes(self):
+        return self.unpack()[0]
+
+    @property
+    def ball_agent_id(self):
+        return self.unpack()[1]
+
+    @property
+    def log_p(self):
+        return self.unpack()[4]
+
+
 class State:
-    def __init__(self, rect, x_offset, y_offset, factor=1, n_agent=10):
+    render_cache = RenderCache()
+
+    def __init__(self, rect, x_offset, y_offset, factor=1, n_agent=10, cache_dir=None,
+                 path_table=None):
         """
         Parameters
         ---------
@@ -142,16 +592,28 @@ class State:
             factor of edge of six-direction
         n_agent: int
             number of agent
+        cache_dir: str or None
+            directory of the court geometry cache, None to always rebuild
+        path_table: bool or None
+            all-pairs path table of Position, None for courts up to
+            PATH_TABLE_MAX_NODE nodes
         """
-        self.position = Position(rect, x_offset, y_offset, factor)
+        self.position = Position(rect, x_offset, y_offset, factor, path_table=path_table,
+                                 cache_dir=cache_dir)
         self.n_agent = n_agent
         self.agents = []
         self.ball_agent_id = None
         self.stand_place = []
         self.stand_place_link = {}
+        self.stand_place_adj = {}  # node -> list of linked nodes
+        self.stand_place_pairs = set()  # (node, node) of every link
         self.screen_one = []
         self.run_one = []
         self.log_p = 0
+        self.occupancy = {}  # node -> tuple of the agent ids on it
+        # per offense agent (basket_distance, min_distance, min_agent_id) as
+        # basket_distance / defense_distance return them, None until used
+        self.features = None
 
         self.virtual_actions = [[0, -2], [1, -1], [1, +1],
                                 [0, 2], [-1, +1], [-1, -1], [0, 0]]
@@ -159,9 +621,9 @@ class State:
     def set_agents(self, vpos_offense_agents, vpos_defense_agents, vpos_stand_place_link=None):
         self.agents = [None] * (len(vpos_offense_agents) + len(vpos_defense_agents))
         for i, vpos in enumerate(vpos_offense_agents):
-            self.agents[i] = Agent(vpos)
+            self.agents[i] = Agent(vpos, self.position.node_id(vpos))
         for i, vpos in enumerate(vpos_defense_agents):
-            self.agents[i+len(vpos_offense_agents)] = Agent(vpos)
+            self.agents[i+len(vpos_offense_agents)] = Agent(vpos, self.position.node_id(vpos))
         if vpos_stand_place_link is not None:
             self.stand_place = []
             self.stand_place_link = {}
@@ -178,12 +640,102 @@ class State:
                     self.stand_place_link[str(pair[1])] = []
                 if pair[0] not in self.stand_place_link[str(pair[1])]:
                     self.stand_place_link[str(pair[1])].append(pair[0])
+            self.build_stand_place_index()
         self.ball_agent_id = 0
+        self.build_occupancy()
+
+    def build_stand_place_index(self):
+        """node based stand_place_adj and stand_place_pairs of stand_place_link"""
+        self.stand_place_adj = {}
+        self.stand_place_pairs = set()
+        for vpos_1 in self.stand_place:
+            node_1 = self.position.node_id(vpos_1)
+            self.stand_place_adj[node_1] = []
+            for vpos_2 in self.stand_place_link[str(vpos_1)]:
+                node_2 = self.position.node_id(vpos_2)
+                self.stand_place_adj[node_1].append(node_2)
+                self.stand_place_pairs.add((node_1, node_2))
 
     def my_deep_copy(self):
-        self.agents = copy.deepcopy(self.agents)
-        self.screen_one = copy.deepcopy(self.screen_one)
-        self.run_one = copy.deepcopy(self.run_one)
+        # positions are never changed in place, so copying the Agent objects is enough
+        self.agents = [copy.copy(agent) for agent in self.agents]
+        self.screen_one = list(self.screen_one)
+        self.run_one = list(self.run_one)
+        # the tuples of both are replaced, never changed
+        self.occupancy = dict(self.occupancy)
+        if self.features is not None:
+            self.features = list(self.features)
+
+    def build_occupancy(self):
+        """occupancy of the current agents from scratch, features are dropped"""
+        self.occupancy = {}
+        for i in range(len(self.agents)):
+            node = self.get_agent_node(i)
+            if node is not None:
+                self.occupancy[node] = self.occupancy.get(node, ()) + (i,)
+        self.features = None
+
+    def set_agent_pos(self, agent_id, vpos, node=None):
+        """
+        Put agent_id on vpos (lattice node node, resolved if None). Every
+        agent move goes through here so that occupancy and features
+        follow the move.
+        """
+        if node is None:
+            node = self.position.node_id(vpos)
+        agent = self.agents[agent_id]
+        occupancy = self.occupancy
+        # build_occupancy resolved the node of every agent
+        old_node = agent.node
+        if old_node is not None:
+            occupants = occupancy[old_node]
+            if len(occupants) == 1:
+                del occupancy[old_node]
+            else:
+                occupancy[old_node] = tuple(i for i in occupants if i != agent_id)
+        agent.virtual_pos = vpos
+        agent.node = node
+        if node is not None:
+            occupants = occupancy.get(node)
+            occupancy[node] = (agent_id,) if occupants is None else occupants + (agent_id,)
+        if self.features is not None:
+            self.update_features(agent_id)
+
+    def compact(self):
+        """
+        Returns
+        -------
+        compact: CompactState
+            hashable snapshot of agent nodes, ball holder, screen_one,
+            run_one and log_p, ValueError if an agent is off the lattice
+        """
+        nodes = []
+        for i in range(len(self.agents)):
+            node = self.get_agent_node(i)
+            if node is None:
+                raise ValueError("agent {} is off the lattice".format(i))
+            nodes.append(node)
+        screen_mask = 0
+        for agent_id in self.screen_one:
+            screen_mask |= 1 << agent_id
+        run_mask = 0
+        for agent_id in self.run_one:
+            run_mask |= 1 << agent_id
+        return CompactState.pack(nodes, self.ball_agent_id, screen_mask, run_mask, self.log_p,
+                                 self.position.n_node)
+
+    def set_compact(self, compact):
+        """load a CompactState of this court into self, in place"""
+        nodes, ball_agent_id, screen_mask, run_mask, log_p = compact.unpack()
+        if len(self.agents) != len(nodes):
+            self.agents = [Agent(None) for _ in nodes]
+        for agent, node in zip(self.agents, nodes):
+            agent.set_vpos(self.position.node_vpos(node), node)
+        self.build_occupancy()
+        self.ball_agent_id = ball_agent_id
+        self.screen_one = [i for i in range(len(nodes)) if screen_mask >> i & 1]
+        self.run_one = [i for i in range(len(nodes)) if run_mask >> i & 1]
+        self.log_p = log_p
 
     def get_agent_number(self):
         return self.n_agent
@@ -206,39 +758,93 @@ class State:
         return self.virtual_actions
 
     def move_agent_to(self, agent_id, vpos):
-        self.agents[agent_id].set_vpos(vpos)
+        self.set_agent_pos(agent_id, vpos, self.position.node_id(vpos))
 
-    def get_successor_state(self, agent_id, move):
-        agent = self.agents[agent_id]
-        virtual_pos = agent.get_virtual_pos()
-        new_virtual_pos = [sum(x) for x in zip(virtual_pos, move)]
-
-        check = True
-        if not self.virtual_pos_is_null(agent_id, new_virtual_pos):
-            check = False
-        if not self.position.virtual_is_in(new_virtual_pos):
-            check = False
+    def move_agent_to_node(self, agent_id, node):
+        self.set_agent_pos(agent_id, self.position.node_vpos(node), node)
 
+    def get_successor_state(self, agent_id, move):
         #new_state = copy.deepcopy(self)
         new_state = copy.copy(self)
         new_state.my_deep_copy()
-        #new_state.agents = copy.deepcopy(self.agents)
-        if check:
-            new_state.agents[agent_id].move(move)
+        new_state.apply(agent_id, move)
         return new_state
 
+    def apply(self, agent_id, move):
+        """
+        In-place get_successor_state: move agent_id by move if the new
+        place is free and inside the court.
+
+        Returns
+        -------
+        token: tuple
+            pass to undo() to restore the state
+        """
+        agent = self.agents[agent_id]
+        token = (agent_id, agent.virtual_pos, agent.node)
+        target = self.move_target(agent_id, move)
+        if target is not None:
+            self.set_agent_pos(agent_id, target[0], target[1])
+        return token
+
+    def move_target(self, agent_id, move):
+        """
+        Returns
+        -------
+        target: (virtual_pos, node) or None
+            where apply() would put agent_id, None if the move is blocked;
+            the state is not changed
+        """
+        virtual_pos = self.agents[agent_id].virtual_pos
+        new_virtual_pos = [virtual_pos[0] + move[0], virtual_pos[1] + move[1]]
+        new_node = self.position.node_id(new_virtual_pos)
+        if new_node is None:
+            if (not self.virtual_pos_is_null(agent_id, new_virtual_pos)
+                    or not self.position.virtual_is_in(new_virtual_pos)):
+                return None
+        elif not self.node_is_null(agent_id, new_node):
+            return None
+        return new_virtual_pos, new_node
+
+    def undo(self, token):
+        agent_id, virtual_pos, node = token
+        agent = self.agents[agent_id]
+        if agent.virtual_pos is not virtual_pos:
+            self.set_agent_pos(agent_id, virtual_pos, node)
+
     def get_agent_virtual_pos(self, agent_id):
         try:
             return self.agents[agent_id].get_virtual_pos()
         except:
             return None
 
+    def get_agent_node(self, agent_id):
+        agent = self.agents[agent_id]
+        if agent.node is None:
+            agent.node = self.position.node_id(agent.virtual_pos)
+        return agent.node
+
+    def get_linked_nodes(self, node):
+        """stand place nodes linked with node, KeyError if node is not a stand place"""
+        return self.stand_place_adj[node]
+
+    def is_linked(self, node_1, node_2):
+        return (node_1, node_2) in self.stand_place_pairs
+
     def get_basket_virtual_pos(self):
         return [0, 0]
 
     def get_shortest_path(self, a, b):
         return self.position.get_shortest_path(a, b)
 
+    def next_hop(self, a, b):
+        return self.position.next_hop(a, b)
+
+    def node_is_null(self, agent_id, node):
+        """True if no agent but agent_id is on node"""
+        occupants = self.occupancy.get(node)
+        return occupants is None or occupants == (agent_id,)
+
     def virtual_pos_is_null(self, agent_id, virtual_pos):
         for i, agent in enumerate(self.agents):
             if i == agent_id:
@@ -249,64 +855,131 @@ class State:
 
     def basket_distance(self, agent_id):
         assert agent_id < self.n_agent / 2
-
-        vpos_agent = self.get_agent_virtual_pos(agent_id)
-        vpos_basket = self.get_basket_virtual_pos()
-
-        return self.position.real_distance(vpos_agent, vpos_basket)
+        if self.features is None:
+            self.build_features()
+        return self.features[agent_id][0]
 
     def defense_distance(self, agent_id):
-        def cross_product(a, b):
-            return a[0] * b[0] + a[1] * b[1]
-
+        """
+        Returns
+        -------
+        min_distance, min_agent_id:
+            the nearest defense agent on the basket side of agent_id
+            (the first one on a tie), -1, None if there is none
+        """
         assert agent_id < self.n_agent / 2
-        vpos_defense_agents = []
-        for i in range(self.n_agent):
-            if i >= int(self.n_agent / 2):
-                vpos_defense_agents.append(self.get_agent_virtual_pos(i))
-        vpos_basket = self.get_basket_virtual_pos()
-        min_distance = None
-        min_agent_id = None
-        for j in range(len(vpos_defense_agents)):
-            virtual_off = self.get_agent_virtual_pos(agent_id)
-            virtual_def = vpos_defense_agents[j]
-            real_off = self.position.virtual_to_real(virtual_off)
-            real_def = self.position.virtual_to_real(virtual_def)
-            real_basket = self.position.virtual_to_real(vpos_basket)
-            vector_off = [a - b for a, b in zip(real_basket, real_off)]
-            vector_def = [a - b for a, b in zip(real_def, real_off)]
-            if cross_product(vector_off, vector_def) > 0:
-                if min_distance is None or self.position.real_distance(virtual_off, virtual_def) < min_distance:
-                    min_distance = self.position.real_distance(virtual_off, virtual_def)
-                    min_agent_id = j + int(self.n_agent / 2)
+        if self.features is None:
+            self.build_features()
+        _, min_distance, min_agent_id = self.features[agent_id]
         if min_distance is None:
             return -1, None
         return min_distance, min_agent_id
 
+    def build_features(self):
+        """features of every offense agent from scratch"""
+        self.features = [self.offense_features(i) for i in range(int(self.n_agent / 2))]
+
+    def offense_features(self, agent_id):
+        """
+        Returns
+        -------
+        basket_distance, min_distance, min_agent_id:
+            min_distance and min_agent_id are None without a basket side
+            defense agent
+        """
+        real_off = self.agent_real_pos(agent_id)
+        real_basket = self.position.virtual_to_real(self.get_basket_virtual_pos())
+        basket_distance = pow(pow(real_off[0] - real_basket[0], 2)
+                              + pow(real_off[1] - real_basket[1], 2), 0.5)
+        min_distance = None
+        min_agent_id = None
+        for j in range(int(self.n_agent / 2), self.n_agent):
+            distance = self._basket_side_distance(real_off, real_basket, self.agent_real_pos(j))
+            if distance is not None and (min_distance is None or distance < min_distance):
+                min_distance = distance
+                min_agent_id = j
+        return basket_distance, min_distance, min_agent_id
+
+    def update_features(self, agent_id):
+        """
+        Update features after agent_id moved. An offense agent only changes
+        its own entry. A defense agent is compared with the cached nearest
+        defender of every offense agent, only the entries it was the
+        nearest of are computed again.
+        """
+        n_offense = int(self.n_agent / 2)
+        if agent_id < n_offense:
+            self.features[agent_id] = self.offense_features(agent_id)
+            return
+        if agent_id >= self.n_agent:
+            return
+        real_def = self.agent_real_pos(agent_id)
+        real_basket = self.position.virtual_to_real(self.get_basket_virtual_pos())
+        for i in range(n_offense):
+            basket_distance, min_distance, min_agent_id = self.features[i]
+            if min_agent_id == agent_id:
+                self.features[i] = self.offense_features(i)
+                continue
+            distance = self._basket_side_distance(self.agent_real_pos(i), real_basket, real_def)
+            if distance is None:
+                continue
+            if (min_distance is None or distance < min_distance
+                    or (distance == min_distance and agent_id < min_agent_id)):
+                self.features[i] = (basket_distance, distance, agent_id)
+
+    def agent_real_pos(self, agent_id):
+        node = self.get_agent_node(agent_id)
+        if node is None:
+            return self.position.virtual_to_real(self.agents[agent_id].virtual_pos)
+        return self.position.real_pos[node]
+
+    @staticmethod
+    def _basket_side_distance(real_off, real_basket, real_def):
+        """distance offense - defense if the defense is on the basket side, else None"""
+        vector_off = [real_basket[0] - real_off[0], real_basket[1] - real_off[1]]
+        vector_def = [real_def[0] - real_off[0], real_def[1] - real_off[1]]
+        if vector_off[0] * vector_def[0] + vector_off[1] * vector_def[1] > 0:
+            return pow(pow(real_off[0] - real_def[0], 2) + pow(real_off[1] - real_def[1], 2), 0.5)
+        return None
+
     def is_open(self, agent_id):
         real_three_point = 6.75
         if self.basket_distance(agent_id) < real_three_point+1 and self.defense_distance(agent_id)[0] < 0:
             return True
         return False
 
-    def real_to_close_virtual(self, rpos_mouse):
-        def real_distance(a, b):
-            return pow(pow(a[0] - b[0], 2) + pow(a[1] - b[1], 2), 0.5)
-        for vpos in self.position.virtual_pos:
-            rpos = self.position.virtual_to_real(vpos)
-            if real_distance(rpos_mouse, rpos) < 0.5:
-                return vpos
-        return None
+    def real_to_close_virtual(self, rpos_mouse, radius=0.5):
+        """
+        Returns
+        -------
+        vpos: [x, y] or None
+            the lattice place nearest to real position rpos_mouse,
+            None if there is none closer than radius
+        """
+        node = self.position.nearest_node(rpos_mouse, radius)
+        if node is None:
+            return None
+        return self.position.virtual_pos[node]
 
     def draw(self, surf, palette, x_offset, y_offset, factor=1):
-        # position
+        self.draw_lattice(surf, x_offset, y_offset, factor)
+        self.draw_links(surf, palette, x_offset, y_offset, factor)
+        for sprite in self.agent_sprites(palette, x_offset, y_offset, factor):
+            self.draw_sprite(surf, sprite)
+
+    def draw_lattice(self, surf, x_offset, y_offset, factor=1):
+        # imported here so that state and strategy run without pygame
+        import pygame
+
         real_pos = self.position.get_real_pos()
         for pos in real_pos:
             x = int(pos[0] * factor + x_offset)
             y = int(pos[1] * factor + y_offset)
             pygame.draw.circle(surf, (220, 220, 220), [x, y], 2)
 
-        # link
+    def draw_links(self, surf, palette, x_offset, y_offset, factor=1):
+        import pygame
+
         for v1 in self.stand_place:
             for v2 in self.stand_place_link[str(v1)]:
                 real_pos = self.position.virtual_to_real(v1)
@@ -319,31 +992,64 @@ class State:
                 surf_v2 = [x, y]
                 pygame.draw.line(surf, palette.green, surf_v1, surf_v2, 2)
 
-        # agent
+    def agent_sprites(self, palette, x_offset, y_offset, factor=1, real_pos=None):
+        """
+        Parameters
+        ---------
+        real_pos: list or None
+            real coordinates to draw each agent at instead of its place,
+            used for animation
+        Returns
+        -------
+        sprites: list of tuple
+            (text, x, y, r_agent, colors, text_color) of every agent,
+            colors are the filled circles from the outside in
+        """
+        sprites = []
+        r_agent = int(1. * self.position.get_real_distance() / 2 * factor)
         for i, agent in enumerate(self.agents):
             if agent is None:
                 continue
-            virtual_pos = agent.get_virtual_pos()
-            real_pos = self.position.virtual_to_real(virtual_pos)
-            x = int(real_pos[0] * factor + x_offset)
-            y = int(real_pos[1] * factor + y_offset)
-            r_agent = int(1. * self.position.get_real_distance() / 2 * factor)
+            if real_pos is None:
+                agent_real_pos = self.position.virtual_to_real(agent.get_virtual_pos())
+            else:
+                agent_real_pos = real_pos[i]
+            x = int(agent_real_pos[0] * factor + x_offset)
+            y = int(agent_real_pos[1] * factor + y_offset)
             if i < self.n_agent / 2:
                 if i == self.ball_agent_id:  # draw ball_agent_id
-                    pygame.draw.circle(surf, palette.red, [x, y], r_agent)
-                    pygame.draw.circle(surf, palette.white, [x, y], r_agent - 2)
-                    font = pygame.font.Font(None, 24)
-                    agent_id_text = font.render(str(i), 1, (0, 0, 0))
-                    surf.blit(agent_id_text, [x - int(r_agent / 2), y - int(r_agent / 2)])
+                    colors = (palette.red, palette.white)
+                    text_color = (0, 0, 0)
                 else:
-                    pygame.draw.circle(surf, palette.red, [x, y], r_agent)
-                    font = pygame.font.Font(None, 24)
-                    agent_id_text = font.render(str(i), 1, (255, 255, 255))
-                    surf.blit(agent_id_text, [x - int(r_agent / 2), y - int(r_agent / 2)])
+                    colors = (palette.red,)
+                    text_color = (255, 255, 255)
             else:
-                pygame.draw.circle(surf, palette.blue, [x, y], r_agent)
-                font = pygame.font.Font(None, 24)
-                agent_id_text = font.render(str(i), 1, (255, 255, 255))
-                surf.blit(agent_id_text, [x - int(r_agent / 2), y - int(r_agent / 2)])
+                colors = (palette.blue,)
+                text_color = (255, 255, 255)
+            sprites.append((str(i), x, y, r_agent, colors, text_color))
+        return sprites
+
+    def draw_sprite(self, surf, sprite):
+        """
+        sprite: (text, x, y, r, colors, text_color), no label when
+        text_color is None
+        """
+        import pygame
+
+        text, x, y, r_agent, colors, text_color = sprite
+        for k, color in enumerate(colors):
+            pygame.draw.circle(surf, color, [x, y], r_agent - 2 * k)
+        if text_color is not None:
+            agent_id_text = self.render_cache.glyph(text, text_color)
+            surf.blit(agent_id_text, [x - int(r_agent / 2), y - int(r_agent / 2)])
 
+    def sprite_rect(self, sprite):
+        """screen rect covering everything draw_sprite paints"""
+        import pygame
 
+        text, x, y, r_agent, _, text_color = sprite
+        rect = pygame.Rect(x - r_agent - 1, y - r_agent - 1, 2 * r_agent + 3, 2 * r_agent + 3)
+        if text_color is None:
+            return rect
+        size = self.render_cache.glyph(text, text_color).get_size()
+        return rect.union(pygame.Rect([x - int(r_agent / 2), y - int(r_agent / 2)], size))
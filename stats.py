@@ -0,0 +1,131 @@
+"""
+Search statistics and tracing for the strategies.
+
+A Strategy records into its stats attribute, a SearchStats or None. With
+None (the default) every hook is a single attribute test, so searches
+without stats run as before:
+
+    offense = MotionOffense(0.2, 0.8)
+    offense.set_stats(SearchStats(trace=True))
+    offense.next_move(state, 3)
+    print(offense.stats.summary())
+    offense.stats.write_json("stats.json")
+    offense.stats.write_chrome_trace("trace.json")  # chrome://tracing, Perfetto
+
+Counters recorded by the searches:
+    nodes                nodes expanded, per remaining depth
+    moves_generated      moves produced by move generation
+    moves_refined_away   moves dropped by refine_possible_moves
+    moves_cut            partial moves cut early by MotionOffense.iter_moves
+    successor_copies     states copied by get_successor_state
+    leaf_evals           evaluation_function calls / batched leaf values
+    cache_hits, cache_misses
+                         transposition table lookups
+    bound_cuts           subtrees cut by the lower bound of bounded search
+    beam_dropped         children dropped by beam search
+and wall time per phase (search, iteration, movegen, leaf_eval).
+"""
+import os
+import json
+import time
+import threading
+
+
+class SearchStats:
+    def __init__(self, trace=False, max_events=100000):
+        """
+        Parameters
+        ---------
+        trace: bool
+            also keep every phase as a timed event for write_chrome_trace
+        max_events: int
+            trace events kept, later ones are counted in dropped_events
+        """
+        self.trace = trace
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self):
+        self.nodes = {}  # remaining depth -> nodes expanded
+        self.counters = {}
+        self.phases = {}  # name -> [seconds, calls]
+        self.events = []  # instant events: (name, timestamp, args)
+        self.trace_events = []
+        self.dropped_events = 0
+        self.origin = time.perf_counter()
+
+    def node(self, depth):
+        self.nodes[depth] = self.nodes.get(depth, 0) + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def clock(self):
+        return time.perf_counter()
+
+    def add_phase(self, name, start, args=None):
+        """add the time since start, a clock() value, to phase name"""
+        end = time.perf_counter()
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0., 0]
+        phase[0] += end - start
+        phase[1] += 1
+        if self.trace:
+            self._trace_event({"name": name, "ph": "X", "ts": self._us(start),
+                               "dur": 1e6 * (end - start)}, args)
+
+    def event(self, name, **args):
+        """
+        instant event, e.g. the move a search returned; args must be JSON
+        serializable
+        """
+        now = time.perf_counter()
+        self.events.append((name, now - self.origin, args))
+        if self.trace:
+            self._trace_event({"name": name, "ph": "i", "s": "t", "ts": self._us(now)}, args)
+
+    def _us(self, t):
+        return 1e6 * (t - self.origin)
+
+    def _trace_event(self, event, args):
+        if len(self.trace_events) >= self.max_events:
+            self.dropped_events += 1
+            return
+        event["pid"] = os.getpid()
+        event["tid"] = threading.get_ident()
+        if args:
+            event["args"] = args
+        self.trace_events.append(event)
+
+    def to_dict(self):
+        return {
+            "nodes": {str(depth): n for depth, n in sorted(self.nodes.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "phases": {name: {"seconds": seconds, "calls": calls}
+                       for name, (seconds, calls) in sorted(self.phases.items())},
+            "events": [{"name": name, "time": t, "args": args}
+                       for name, t, args in self.events],
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def write_chrome_trace(self, path):
+        """trace events in the Chrome trace event format, needs trace=True"""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms",
+                       "otherData": {"dropped_events": self.dropped_events}}, f)
+
+    def summary(self):
+        """human readable counters and phase times"""
+        lines = []
+        if self.nodes:
+            lines.append("nodes by remaining depth: " + ", ".join(
+                "{}: {}".format(depth, n) for depth, n in sorted(self.nodes.items())))
+        for name, n in sorted(self.counters.items()):
+            lines.append("{:20s} {:12d}".format(name, n))
+        for name, (seconds, calls) in sorted(self.phases.items()):
+            lines.append("{:20s} {:12.6f} s in {} calls".format(name, seconds, calls))
+        return "\n".join(lines)
@@ -1,15 +1,44 @@
 import state
+import sys
 import random
 import copy
 import time
 import math
 from operator import itemgetter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Strategy:
+    # a stats.SearchStats the searches record into, None records nothing
+    stats = None
+
     def __init__(self):
+        self.n_jobs = 1
+        self._pool = None
         pass
 
+    def set_stats(self, stats):
+        """
+        record search statistics into stats, a stats.SearchStats, from now
+        on; None stops recording. Returns stats.
+        """
+        self.stats = stats
+        return stats
+
+    def _map(self, func, tasks):
+        """func over tasks in a process pool of n_jobs workers, results in task order"""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.n_jobs)
+        chunksize = max(1, len(tasks) // (4 * self.n_jobs))
+        return list(self._pool.map(func, tasks, chunksize=chunksize))
+
+    def close(self):
+        """shut down the process pool of a parallel search"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
     def get_next_move(self, agent_id, state):
         pass
 
@@ -24,29 +53,158 @@ class Brownian(Strategy):
         return move
 
 
+class _SearchTimeout(Exception):
+    pass
+
+
+# states and strategies of a worker process of a parallel root search,
+# kept between tasks so that the worker caches stay warm
+_WORKER_STATES = {}
+_WORKER_STRATEGIES = {}
+
+
+def _parallel_context(state):
+    """
+    Picklable description of what a worker needs besides the agents to
+    rebuild state: court key, geometry cache, n_agent and stand places
+    with their links in order (the link order decides the move order).
+    """
+    position = state.position
+    links = tuple((key, tuple(tuple(vpos) for vpos in vposes))
+                  for key, vposes in state.stand_place_link.items())
+    return (position.key, position.cache_dir, state.n_agent,
+            tuple(tuple(vpos) for vpos in state.stand_place), links)
+
+
+def _worker_state(context, compact):
+    worker_state = _WORKER_STATES.get(context)
+    if worker_state is None:
+        key, cache_dir, n_agent, stand_place, stand_place_link = context
+        for other in _WORKER_STATES.values():
+            if other.position.key == key and other.n_agent == n_agent:
+                # same court, reuse the built position
+                worker_state = copy.copy(other)
+                worker_state.my_deep_copy()
+                break
+        else:
+            worker_state = state.State(list(key[:4]), key[4], key[5], factor=key[6],
+                                       n_agent=n_agent, cache_dir=cache_dir)
+        worker_state.stand_place = [list(vpos) for vpos in stand_place]
+        worker_state.stand_place_link = {name: [list(vpos) for vpos in vposes]
+                                         for name, vposes in stand_place_link}
+        worker_state.build_stand_place_index()
+        if len(_WORKER_STATES) >= 16:
+            _WORKER_STATES.clear()
+        _WORKER_STATES[context] = worker_state
+    worker_state.set_compact(compact)
+    return worker_state
+
+
+def _worker_strategy(spec):
+    """spec: (class name, constructor arguments)"""
+    strategy = _WORKER_STRATEGIES.get(spec)
+    if strategy is None:
+        strategy = globals()[spec[0]](*spec[1])
+        _WORKER_STRATEGIES[spec] = strategy
+    return strategy
+
+
+def _minimax_child_task(task):
+    """value of the root child move_index and the nodes searched below it"""
+    context, compact, spec, agent_id, move_index, depth = task
+    worker_state = _worker_state(context, compact)
+    minimax = _worker_strategy(spec)
+    token = worker_state.apply(agent_id, worker_state.get_legal_moves()[move_index])
+    next_agent_id = (agent_id + 1) % worker_state.n_agent
+    if depth <= 1:
+        s = minimax.evaluation_function(worker_state)
+        node_count = 1
+    elif minimax.alpha_beta:
+        s, _ = minimax.alpha_beta_search(next_agent_id, worker_state, depth - 1)
+        node_count = minimax.node_count
+    else:
+        s, _ = minimax.full_width_search(next_agent_id, worker_state, depth - 1)
+        node_count = minimax.node_count
+    worker_state.undo(token)
+    return s, node_count
+
+
+def _motion_child_task(task):
+    """
+    successor log_p of one root move and the nodes searched below it;
+    with a bound, bounded_next_move only looks for scores below it
+    """
+    context, compact, spec, move, time_step, bound = task
+    worker_state = _worker_state(context, compact)
+    offense = _worker_strategy(spec)
+    node_count = offense.node_count
+    token = offense.apply(worker_state, move)
+    if bound is None:
+        _, successor_log_p = offense.next_move(worker_state, time_step - 1)
+    else:
+        _, successor_log_p = offense.bounded_next_move(worker_state, time_step - 1, bound)
+    offense.undo(worker_state, token)
+    return successor_log_p, offense.node_count - node_count
+
+
+# bound types of a transposition table value
+_EXACT = 0
+_LOWER = 1
+_UPPER = 2
+
+
 class Minimax(Strategy):
-    def __init__(self):
+    # fewest agents batch_leaves is used for: a batch scores every leaf of a
+    # node, up to 7, where the scalar search stops at the first cutoff, so
+    # it only pays off when each scalar evaluation compares many agents
+    # (10 agents, depth 4: 0.22 s -> 0.15 s; 6 agents: 0.07 s -> 0.14 s)
+    batch_min_agent = 8
+
+    def __init__(self, alpha_beta=True, transposition_size=1000000, seed=0, n_jobs=1,
+                 batch_leaves=False):
+        """
+        Parameters
+        ---------
+        alpha_beta: bool
+            use alpha_beta_search, otherwise full_width_search
+        transposition_size: int
+            entries kept in the transposition table before it is cleared
+        seed: int
+            seed of the Zobrist keys
+        n_jobs: int
+            > 1 searches the root moves in a pool of n_jobs processes,
+            see parallel_search
+        batch_leaves: bool
+            alpha_beta_search scores the leaves below a node at once with
+            vector_eval (needs numpy) in states of at least
+            batch_min_agent agents, see leaf_values
+        """
         super().__init__()
+        self.n_jobs = n_jobs
+        self.batch_leaves = batch_leaves
+        self.leaf_evaluator = None
+        self.alpha_beta = alpha_beta
+        self.transposition_size = transposition_size
+        self.seed = seed
+        self.zobrist_position = None
+        self.zobrist_agent = None
+        self.zobrist_ball = None
+        self.zobrist_turn = None
+        self.transposition = {}
+        self.best_moves = {}
+        self.node_count = 0
+        self.completed_depth = 0
 
     def evaluation_function(self, state):
-        def cross_product(a, b):
-            return a[0] * b[0] + a[1] * b[1]
-
-        vpos_offense_agents = []
-        vpos_defense_agents = []
-        for i in range(state.n_agent):
-            if i < state.n_agent / 2:
-                vpos_offense_agents.append(state.get_agent_virtual_pos(i))
-            else:
-                vpos_defense_agents.append(state.get_agent_virtual_pos(i))
-        vpos_basket = state.get_basket_virtual_pos()
-
+        """
+        reads the per offense agent features State keeps up to date
+        while agents move, so a leaf costs O(n_offense)
+        """
         ret = 0
         # if offense agent far from basket
-        for i in range(len(vpos_offense_agents)):
+        for i in range(int(state.n_agent / 2)):
             real_three_point = 6.75
-            if state.position.real_distance(vpos_offense_agents[i],
-                    vpos_basket) > real_three_point + 1:
+            if state.basket_distance(i) > real_three_point + 1:
                 ret -= 10000
         """
         # if offense close to basket
@@ -59,51 +217,350 @@ class Minimax(Strategy):
                 ret += 1000
         return ret
 
-    def next_move(self, agent_id, state, depth=3):
+    def leaf_values(self, agent_id, state, moves):
+        """
+        evaluation_function of the state after each of moves of agent_id,
+        computed in one vector_eval batch from the agent nodes
+
+        Returns
+        -------
+        values: list or None
+            None if an agent is off the lattice
+        """
+        if self.leaf_evaluator is None or self.leaf_evaluator.position is not state.position:
+            import vector_eval
+            real_basket = state.position.virtual_to_real(state.get_basket_virtual_pos())
+            self.leaf_evaluator = vector_eval.LeafEvaluator(state.position, real_basket)
+        nodes = [state.get_agent_node(i) for i in range(state.n_agent)]
+        if None in nodes:
+            return None
+        leaves = []
+        for move in moves:
+            # the node apply() would move to, without maintaining the
+            # occupancy and features of a state that is thrown away
+            target = state.move_target(agent_id, move)
+            node = nodes[agent_id] if target is None else target[1]
+            if node is None:
+                return None
+            leaf = list(nodes)
+            leaf[agent_id] = node
+            leaves.append(leaf)
+        return self.leaf_evaluator.evaluate_nodes(leaves, int(state.n_agent / 2))
+
+    def evaluation_bounds(self, state):
+        """lowest and highest value evaluation_function can return"""
+        n_offense = int(state.n_agent / 2)
+        return -10000 * n_offense, 1000 * n_offense
+
+    def next_move(self, agent_id, state, depth=3, time_budget=None):
+        """
+        Parameters
+        ---------
+        depth: int
+            number of agent moves to search
+        time_budget: float or None
+            seconds for iterative deepening, the deepest completed depth wins
+        """
+        stats = self.stats
+        if stats is not None:
+            start = stats.clock()
+        if self.n_jobs > 1 and time_budget is None:
+            s, m = self.parallel_search(agent_id, state, depth)
+        elif self.alpha_beta:
+            s, m = self.alpha_beta_search(agent_id, state, depth, time_budget)
+        else:
+            s, m = self.full_width_search(agent_id, state, depth)
+
+        if stats is not None:
+            stats.add_phase("search", start, {"agent_id": agent_id, "depth": depth})
+            args = {"agent_id": agent_id, "move": m, "score": s}
+            if agent_id < state.n_agent / 2:
+                # only offense agents have a defense distance
+                args["defense_distance"] = state.defense_distance(agent_id)
+            stats.event("next_move", **args)
+        return m
+
+    def full_width_search(self, agent_id, state, depth):
+        """plain minimax over every move, the reference for alpha_beta_search"""
+        stats = self.stats
+
         def min_score(agent_id, state, depth):
+            self.node_count += 1
+            if stats is not None:
+                stats.node(depth)
             if depth == 0:
+                if stats is not None:
+                    stats.count("leaf_evals")
                 return self.evaluation_function(state), None
             moves = state.get_legal_moves()
+            if stats is not None:
+                stats.count("moves_generated", len(moves))
             ret_s = 100000000
             ret_move = None
             next_agent_id = (agent_id + 1) % state.n_agent
             for move in moves:
-                next_state = state.get_successor_state(agent_id, move)
+                token = state.apply(agent_id, move)
                 if next_agent_id < state.n_agent / 2:
-                    s, _ = max_score(next_agent_id, next_state, depth - 1)
+                    s, _ = max_score(next_agent_id, state, depth - 1)
                 else:
-                    s, _ = min_score(next_agent_id, next_state, depth - 1)
+                    s, _ = min_score(next_agent_id, state, depth - 1)
+                state.undo(token)
                 if s < ret_s:
                     ret_s = s
                     ret_move = move
             return ret_s, ret_move
 
         def max_score(agent_id, state, depth):
+            self.node_count += 1
+            if stats is not None:
+                stats.node(depth)
             if depth == 0:
+                if stats is not None:
+                    stats.count("leaf_evals")
                 return self.evaluation_function(state), None
             moves = state.get_legal_moves()
+            if stats is not None:
+                stats.count("moves_generated", len(moves))
             ret_s = -100000000
             ret_move = None
             next_agent_id = (agent_id + 1) % state.n_agent
             for move in moves:
-                next_state = state.get_successor_state(agent_id, move)
+                token = state.apply(agent_id, move)
                 if next_agent_id < state.n_agent / 2:
-                    s, _ = max_score(next_agent_id, next_state, depth - 1)
+                    s, _ = max_score(next_agent_id, state, depth - 1)
                 else:
-                    s, _ = min_score(next_agent_id, next_state, depth - 1)
+                    s, _ = min_score(next_agent_id, state, depth - 1)
+                state.undo(token)
                 if s > ret_s:
                     ret_s = s
                     ret_move = move
             return ret_s, ret_move
 
+        self.node_count = 0
         if agent_id < state.n_agent / 2:
-            s, m = max_score(agent_id, state, depth)
-        else:
-            s, m = min_score(agent_id, state, depth)
+            return max_score(agent_id, state, depth)
+        return min_score(agent_id, state, depth)
 
-        print("next move {} score {}".format(str(m), s))
-        print("defense_distance {}".format(state.defense_distance(agent_id)))
-        return m
+    def parallel_search(self, agent_id, state, depth):
+        """
+        Root moves searched in the process pool, each to its exact value
+        with the full evaluation window. The first move with the best value
+        wins, which is the move the serial searches return. Workers rebuild
+        state from state.compact() and _parallel_context(state).
+        """
+        maximize = agent_id < state.n_agent / 2
+        moves = state.get_legal_moves()
+        context = _parallel_context(state)
+        compact = state.compact()
+        spec = ("Minimax", (self.alpha_beta, self.transposition_size, self.seed, 1,
+                            self.batch_leaves))
+        tasks = [(context, compact, spec, agent_id, i, depth) for i in range(len(moves))]
+        self.node_count = 1
+        ret_s = -100000000 if maximize else 100000000
+        ret_move = None
+        for move, (s, node_count) in zip(moves, self._map(_minimax_child_task, tasks)):
+            self.node_count += node_count
+            if (s > ret_s) if maximize else (s < ret_s):
+                ret_s = s
+                ret_move = move
+        self.completed_depth = depth
+        return ret_s, ret_move
+
+    def zobrist_hash(self, state):
+        """
+        Returns
+        -------
+        h: int or None
+            64 bit hash of agent nodes and ball holder,
+            None if an agent is off the lattice
+        """
+        n_node = state.position.n_node
+        if (self.zobrist_agent is None or len(self.zobrist_agent) != state.n_agent
+                or self.zobrist_position is not state.position):
+            # the table values are only valid for one court
+            self.zobrist_position = state.position
+            rng = random.Random(self.seed)
+            self.zobrist_agent = [[rng.getrandbits(64) for _ in range(n_node)]
+                                  for _ in range(state.n_agent)]
+            self.zobrist_ball = [rng.getrandbits(64) for _ in range(state.n_agent)]
+            self.zobrist_turn = [rng.getrandbits(64) for _ in range(state.n_agent)]
+            self.transposition = {}
+            self.best_moves = {}
+        h = 0
+        for i in range(state.n_agent):
+            node = state.get_agent_node(i)
+            if node is None:
+                return None
+            h ^= self.zobrist_agent[i][node]
+        if state.ball_agent_id is not None:
+            h ^= self.zobrist_ball[state.ball_agent_id]
+        return h
+
+    def alpha_beta_search(self, agent_id, state, depth, time_budget=None):
+        """
+        Alpha-beta with a Zobrist-keyed transposition table and iterative
+        deepening. Root moves are tried in get_legal_moves order with a
+        strict comparison, and transposition entries are only reused at
+        the same remaining depth, so the result equals full_width_search
+        at the same depth. Interior nodes try the best move found by a
+        previous iteration first.
+        """
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+        h = self.zobrist_hash(state)
+        self.node_count = 0
+        self.completed_depth = 0
+        ret = None
+        saved = [(agent.virtual_pos, agent.node) for agent in state.agents]
+        if self.batch_leaves and state.n_agent >= self.batch_min_agent:
+            # leaves are evaluated by vector_eval from the agent nodes, so the
+            # moves of the search don't need to keep state.features up to
+            # date; it is built again when evaluation_function needs it
+            state.features = None
+        stats = self.stats
+        for d in range(1, depth + 1):
+            if stats is not None:
+                start = stats.clock()
+            try:
+                ret = self._alpha_beta_root(agent_id, state, d, h,
+                                            deadline if d > 1 else None)
+            except _SearchTimeout:
+                # the search was stopped between apply and undo
+                for i, (virtual_pos, node) in enumerate(saved):
+                    state.set_agent_pos(i, virtual_pos, node)
+                break
+            finally:
+                if stats is not None:
+                    stats.add_phase("iteration", start, {"depth": d})
+            self.completed_depth = d
+        return ret
+
+    def _alpha_beta_root(self, agent_id, state, depth, h, deadline):
+        maximize = agent_id < state.n_agent / 2
+        next_agent_id = (agent_id + 1) % state.n_agent
+        low, high = self.evaluation_bounds(state)
+        ret_s = -100000000 if maximize else 100000000
+        ret_move = None
+        moves = state.get_legal_moves()
+        if self.stats is not None:
+            self.stats.node(depth)
+            self.stats.count("moves_generated", len(moves))
+        for move in moves:
+            token = state.apply(agent_id, move)
+            next_h = self._child_hash(agent_id, token[2], state.get_agent_node(agent_id), h)
+            if maximize:
+                s = self._alpha_beta(next_agent_id, state, depth - 1,
+                                     max(ret_s, low), high, next_h, deadline)
+                better = s > ret_s
+            else:
+                s = self._alpha_beta(next_agent_id, state, depth - 1,
+                                     low, min(ret_s, high), next_h, deadline)
+                better = s < ret_s
+            state.undo(token)
+            if better:
+                ret_s = s
+                ret_move = move
+            # later moves can't be strictly better than a bound of the evaluation
+            if ret_s == (high if maximize else low):
+                break
+        return ret_s, ret_move
+
+    def _child_hash(self, agent_id, old_node, new_node, h):
+        if h is None or new_node is None:
+            return None
+        return h ^ self.zobrist_agent[agent_id][old_node] ^ self.zobrist_agent[agent_id][new_node]
+
+    def _alpha_beta(self, agent_id, state, depth, alpha, beta, h, deadline):
+        """fail-soft alpha-beta value of state with agent_id to move"""
+        self.node_count += 1
+        stats = self.stats
+        if stats is not None:
+            stats.node(depth)
+        if deadline is not None and self.node_count % 256 == 0 and time.perf_counter() > deadline:
+            raise _SearchTimeout()
+        if depth == 0:
+            if stats is not None:
+                stats.count("leaf_evals")
+            return self.evaluation_function(state)
+
+        key = None
+        if h is not None:
+            key = (h ^ self.zobrist_turn[agent_id], depth)
+            entry = self.transposition.get(key)
+            if entry is not None:
+                value, flag = entry
+                if (flag == _EXACT or (flag == _LOWER and value >= beta)
+                        or (flag == _UPPER and value <= alpha)):
+                    if stats is not None:
+                        stats.count("cache_hits")
+                    return value
+            if stats is not None:
+                stats.count("cache_misses")
+
+        maximize = agent_id < state.n_agent / 2
+        next_agent_id = (agent_id + 1) % state.n_agent
+        moves = state.get_legal_moves()
+        if stats is not None:
+            stats.count("moves_generated", len(moves))
+        order = list(range(len(moves)))
+        if key is not None and key[0] in self.best_moves:
+            best_index = self.best_moves[key[0]]
+            order.remove(best_index)
+            order.insert(0, best_index)
+
+        values = None
+        if depth == 1 and self.batch_leaves and state.n_agent >= self.batch_min_agent:
+            if stats is not None:
+                start = stats.clock()
+            values = self.leaf_values(agent_id, state, moves)
+            if stats is not None:
+                stats.add_phase("leaf_eval", start)
+                if values is not None:
+                    stats.count("leaf_evals", len(values))
+
+        alpha_0 = alpha
+        beta_0 = beta
+        ret_s = -100000000 if maximize else 100000000
+        ret_index = order[0]
+        for i in order:
+            if values is not None:
+                self.node_count += 1
+                if stats is not None:
+                    stats.node(0)
+                s = values[i]
+            else:
+                token = state.apply(agent_id, moves[i])
+                next_h = self._child_hash(agent_id, token[2], state.get_agent_node(agent_id), h)
+                s = self._alpha_beta(next_agent_id, state, depth - 1,
+                                     alpha, beta, next_h, deadline)
+                state.undo(token)
+            if maximize:
+                if s > ret_s:
+                    ret_s = s
+                    ret_index = i
+                alpha = max(alpha, s)
+            else:
+                if s < ret_s:
+                    ret_s = s
+                    ret_index = i
+                beta = min(beta, s)
+            if alpha >= beta:
+                break
+
+        if key is not None:
+            if len(self.transposition) >= self.transposition_size:
+                self.transposition.clear()
+                self.best_moves.clear()
+            if ret_s <= alpha_0:
+                flag = _UPPER
+            elif ret_s >= beta_0:
+                flag = _LOWER
+            else:
+                flag = _EXACT
+            self.transposition[key] = (ret_s, flag)
+            self.best_moves[key[0]] = ret_index
+        return ret_s
 
 
 class Oneonone(Strategy):
@@ -117,26 +574,67 @@ class Oneonone(Strategy):
         vpos_basket = state.get_basket_virtual_pos()
         vpos_offense = state.get_agent_virtual_pos(agent_id - int(state.n_agent / 2))
         vpos_defense = state.get_agent_virtual_pos(agent_id)
-        path_offence = state.get_shortest_path(vpos_offense, vpos_basket)
+        vpos_target = state.next_hop(vpos_offense, vpos_basket)
+        if vpos_target is None:
+            vpos_target = vpos_offense
         try:
-            path_defense = state.get_shortest_path(vpos_defense, path_offence[1])
-        except:
-            path_defense = state.get_shortest_path(vpos_defense, path_offence[0])
+            vpos_next = state.next_hop(vpos_defense, vpos_target)
+        except KeyError:
+            vpos_next = state.next_hop(vpos_defense, vpos_offense)
 
-        try:
-            dx = path_defense[1][0] - vpos_defense[0]
-            dy = path_defense[1][1] - vpos_defense[1]
-        except:
-            dx = 0
-            dy = 0
+        if vpos_next is None:
+            return [0, 0]
+        dx = vpos_next[0] - vpos_defense[0]
+        dy = vpos_next[1] - vpos_defense[1]
         return [dx, dy]
 
 
 class MotionOffense(Strategy):
-    def __init__(self, p_screen, p_unscreen):
+    def __init__(self, p_screen, p_unscreen, transposition_size=100000,
+                 search="exhaustive", beam_width=8, n_jobs=1, move_cache_size=100000):
+        """
+        Parameters
+        ---------
+        p_screen: float
+            prob that defense_agent could catch up
+        p_unscreen: float
+            prob that defense_agent could catch up under screen
+        transposition_size: int
+            entries of the LRU cache of solved subtrees, 0 to disable
+        search: str
+            "exhaustive" expands every move (the reference),
+            "bounded" prunes with a lower bound on log_p and gives the
+            same result, "beam" keeps only beam_width moves per node
+        beam_width: int
+            moves kept per node by the beam search
+        n_jobs: int
+            > 1 searches the root moves in a pool of n_jobs processes,
+            see parallel_next_move for its extra work
+        move_cache_size: int
+            moves (of all formations together) kept in the LRU cache of
+            move lists, about 300 B each, 0 to disable, see get_moves
+        """
         super().__init__()
+        self.n_jobs = n_jobs
+        assert search in ("exhaustive", "bounded", "beam")
         self.p_screen = p_screen
         self.p_unscreen = p_unscreen
+        self.search = search
+        self.beam_width = beam_width
+        self.node_count = 0
+        self.transposition_size = transposition_size
+        self.transposition = OrderedDict()
+        self.lower_bounds = {}  # key -> lower bound of a subtree cut by bounded_next_move
+        self.transposition_links = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.move_cache_size = move_cache_size
+        self.move_cache = OrderedDict()  # formation_key -> tuple of compact moves
+        self.move_cache_moves = 0  # moves in self.move_cache
+        self.move_cache_evictions = 0  # formations evicted or too large to cache
+        self.move_cache_links = None
+        self.move_cache_hits = 0
+        self.move_cache_misses = 0
 
     def next_move(self, state, time_step):
         """
@@ -156,19 +654,534 @@ class MotionOffense(Strategy):
         log_p: float
             log probability of successful defense
         """
+        stats = self.stats
+        if stats is not None:
+            start = stats.clock()
+        if self.n_jobs > 1:
+            ret = self.parallel_next_move(state, time_step)
+        elif self.search == "bounded":
+            ret = self.bounded_next_move(state, time_step)
+        elif self.search == "beam":
+            ret = self.beam_next_move(state, time_step)
+        else:
+            ret = self.exhaustive_next_move(state, time_step)
+        move, log_p = ret
+        if move is not None:
+            move = self.expand_move(state, move)
+        if stats is not None:
+            stats.add_phase("search", start, {"time_step": time_step})
+            stats.event("next_move", move=move, log_p=log_p)
+        return move, log_p
+
+    def exhaustive_next_move(self, state, time_step):
+        """next_move expanding every move, the reference for the other searches"""
         if time_step == 0:
             return None, state.log_p
-        moves = self.get_step_1_moves(state)
-        moves = self.refine_possible_moves(state, moves)
+        key, ret = self._cache_get(state, time_step)
+        if ret is not None:
+            return ret
+        self.node_count += 1
+        moves = self.get_moves(state)
         cands = []
         for move in moves:
-            new_state = self.get_successor_state(state, move)
-            _, successor_log_p = self.next_move(new_state, time_step - 1)
-            cands.append((new_state.log_p + successor_log_p, move))
+            token = self.apply(state, move)
+            new_log_p = state.log_p
+            _, successor_log_p = self.exhaustive_next_move(state, time_step - 1)
+            self.undo(state, token)
+            cands.append((new_log_p + successor_log_p, move))
             #print(move, self.get_reward(state, move))
+        if self.stats is not None:
+            self.stats.node(time_step)
+            self.stats.count("moves_generated", len(cands))
         cands = sorted(cands, key=itemgetter(0))
         #return move, new_log_p
-        return cands[0][1], cands[0][0]
+        ret = (cands[0][1], cands[0][0])
+        self._cache_put(key, ret)
+        return ret
+
+    def parallel_next_move(self, state, time_step):
+        """
+        next_move with the root moves searched in the process pool, each
+        by a worker MotionOffense in the same search mode. Workers rebuild
+        state from state.compact() and _parallel_context(state); the lowest
+        (score, generation index) wins as in the serial searches, so the
+        result is the serial one.
+
+        Bounded search runs its best child (lowest own log_p) here first
+        and gives the other children its score as their bound. Serially
+        the bound tightens after every child; in the pool it does not, so
+        the workers together expand somewhat more nodes than the serial
+        search (1.0-1.3x at depth 3-4 with 6 agents). With the pool start
+        and the state rebuilt in every worker on top, n_jobs only pays
+        off with a core per job and deep searches.
+        """
+        if time_step == 0:
+            return None, state.log_p
+        self.node_count += 1
+        children = []
+        for i, move in enumerate(self.get_moves(state)):
+            children.append((state.log_p + move[0], i, move))
+        if self.stats is not None:
+            self.stats.node(time_step)
+            self.stats.count("moves_generated", len(children))
+        if self.search != "exhaustive":
+            children.sort(key=itemgetter(0, 1))
+        if self.search == "beam":
+            children = children[:self.beam_width]
+        best = None
+        if self.search == "bounded" and len(children) > 1:
+            log_p, i, move = children.pop(0)
+            token = self.apply(state, move)
+            _, successor_log_p = self.bounded_next_move(state, time_step - 1)
+            self.undo(state, token)
+            best = (log_p + successor_log_p, i, move)
+        context = _parallel_context(state)
+        compact = state.compact()
+        spec = ("MotionOffense", (self.p_screen, self.p_unscreen, self.transposition_size,
+                                  self.search, self.beam_width, 1, self.move_cache_size))
+        tasks = []
+        for log_p, i, move in children:
+            bound = None
+            if best is not None:
+                # an earlier generated move also wins a tie, as in bounded_next_move
+                limit = math.nextafter(best[0], math.inf) if i < best[1] else best[0]
+                bound = limit - log_p
+            tasks.append((context, compact, spec, move, time_step, bound))
+        for (log_p, i, move), (successor_log_p, node_count) in zip(
+                children, self._map(_motion_child_task, tasks)):
+            self.node_count += node_count
+            score = log_p + successor_log_p
+            if best is None or (score, i) < best[:2]:
+                best = (score, i, move)
+        return best[2], best[0]
+
+    def _cache_get(self, state, time_step):
+        """
+        Returns
+        -------
+        key: tuple or None
+            transposition key of state, None when the cache is off
+        ret: (move, log_p) or None
+            cached exact result
+        """
+        if self.transposition_size <= 0:
+            return None, None
+        key = self.state_key(state, time_step)
+        ret = self.transposition.get(key)
+        if ret is not None:
+            self.transposition.move_to_end(key)
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+        if self.stats is not None:
+            self.stats.count("cache_hits" if ret is not None else "cache_misses")
+        return key, ret
+
+    def _cache_put(self, key, ret):
+        if key is None:
+            return
+        self.transposition[key] = ret
+        if len(self.transposition) > self.transposition_size:
+            self.transposition.popitem(last=False)
+
+    def lower_bound(self, state, log_p, time_step):
+        """
+        Lowest score next_move could return from state with accumulated
+        log_p and time_step steps left.
+
+        The score of a line of play is L_1 + ... + L_t + L_t, where L_i is
+        the accumulated log_p after step i, and a step adds one log(p) <= 0
+        per agent that goes to a place linked with the ball holder. Only
+        free agents (not holding the ball, not screening) can go, each to
+        a different place, and only the run_one agents get p_screen. A
+        step that sets up a screens leaves a run_one agents but only
+        n_offense - 1 - a free agents for the next step.
+        """
+        n_free = int(state.n_agent / 2) - 1
+        max_degree = max([len(x) for x in state.stand_place_adj.values()] + [0])
+        r_first = self._step_lower_bound(n_free - len(state.screen_one),
+                                         len(state.run_one), max_degree)
+        r_later = min(self._step_lower_bound(n_free - a, a, max_degree)
+                      for a in range(n_free + 1))
+        k = time_step
+        return ((k + 1) * (log_p + r_first)
+                + r_later * (k * (k - 1) / 2 + k - 1))
+
+    def _step_lower_bound(self, n_free, n_run, max_degree):
+        """lowest reward of one step with n_free free agents, n_run of them run_one"""
+        n_go = max(0, min(n_free, max_degree))
+        n_run = min(n_run, n_free)
+        log_screen = math.log(self.p_screen)
+        log_unscreen = math.log(self.p_unscreen)
+        if log_screen <= log_unscreen:
+            n_screen = min(n_run, n_go)
+        else:
+            n_screen = max(0, n_go - (n_free - n_run))
+        return n_screen * log_screen + (n_go - n_screen) * log_unscreen
+
+    def bounded_next_move(self, state, time_step, bound=math.inf):
+        """
+        Branch-and-bound version of next_move. Children are tried in order
+        of their own log_p, and a subtree is cut once lower_bound shows it
+        can't beat the best score so far. Ties are broken by move
+        generation order, so the result equals the exhaustive search.
+
+        Parameters
+        ---------
+        bound: float
+            only scores below bound are of interest
+        Returns
+        -------
+        move, log_p: as next_move when log_p < bound,
+            otherwise log_p is some value >= bound
+        """
+        if time_step == 0:
+            return None, state.log_p
+        # margin against rounding differences between the bound and the sums
+        margin = 1e-9 * (1 + abs(bound))
+        stats = self.stats
+        lower = self.lower_bound(state, state.log_p, time_step)
+        if lower >= bound + margin:
+            if stats is not None:
+                stats.count("bound_cuts")
+            return None, lower
+        key, ret = self._cache_get(state, time_step)
+        if ret is not None:
+            return ret
+        if key is not None:
+            lower = max(lower, self.lower_bounds.get(key, lower))
+            if lower >= bound + margin:
+                if stats is not None:
+                    stats.count("bound_cuts")
+                return None, lower
+        self.node_count += 1
+        if stats is not None:
+            start = stats.clock()
+        moves = self.get_moves(state)
+        children = []
+        for i, move in enumerate(moves):
+            children.append((state.log_p + move[0], i, move))
+        children.sort(key=itemgetter(0, 1))
+        if stats is not None:
+            stats.add_phase("movegen", start)
+            stats.node(time_step)
+            stats.count("moves_generated", len(children))
+
+        best = None
+        best_i = None
+        best_move = None
+        for log_p, i, move in children:
+            limit = bound
+            if best is not None:
+                # an earlier generated move also wins a tie
+                limit = min(bound, math.nextafter(best, math.inf) if i < best_i else best)
+            token = self.apply(state, move)
+            _, successor_log_p = self.bounded_next_move(state, time_step - 1, limit - log_p)
+            self.undo(state, token)
+            score = log_p + successor_log_p
+            if best is None or score < best or (score == best and i < best_i):
+                best = score
+                best_i = i
+                best_move = move
+        ret = (best_move, best)
+        if best < bound:
+            self._cache_put(key, ret)
+        elif key is not None:
+            # remember that this subtree can't go below best
+            if len(self.lower_bounds) >= self.transposition_size:
+                self.lower_bounds.clear()
+            self.lower_bounds[key] = max(best - margin, self.lower_bounds.get(key, -math.inf))
+        return ret
+
+    def beam_next_move(self, state, time_step):
+        """
+        Approximate next_move for deep horizons: only the beam_width
+        children with the lowest own log_p are expanded at every node.
+        """
+        if time_step == 0:
+            return None, state.log_p
+        self.node_count += 1
+        stats = self.stats
+        if stats is not None:
+            start = stats.clock()
+        moves = self.get_moves(state)
+        children = []
+        for i, move in enumerate(moves):
+            children.append((state.log_p + move[0], i, move))
+        children.sort(key=itemgetter(0, 1))
+        if stats is not None:
+            stats.add_phase("movegen", start)
+            stats.node(time_step)
+            stats.count("moves_generated", len(children))
+            stats.count("beam_dropped", max(0, len(children) - self.beam_width))
+
+        cands = []
+        for log_p, i, move in children[:self.beam_width]:
+            token = self.apply(state, move)
+            _, successor_log_p = self.beam_next_move(state, time_step - 1)
+            self.undo(state, token)
+            cands.append((log_p + successor_log_p, i, move))
+        cands.sort(key=itemgetter(0, 1))
+        return cands[0][2], cands[0][0]
+
+    def state_key(self, state, time_step):
+        """
+        Everything the subtree below state depends on: offense nodes, ball
+        holder, screen_one / run_one in order (their order decides the move
+        order and so the tie-break) and the remaining depth. log_p is part
+        of the key because the score adds up the accumulated log_p of every
+        step, so equal formations with different log_p have different scores.
+        Defense agents don't take part in MotionOffense.
+        """
+        if self.transposition_links is not state.stand_place_pairs:
+            # cached subtrees are only valid for one stand place graph
+            self.transposition.clear()
+            self.lower_bounds.clear()
+            self.transposition_links = state.stand_place_pairs
+        nodes = tuple(state.get_agent_node(i) for i in range(int(state.n_agent / 2)))
+        return (nodes, state.ball_agent_id, tuple(state.screen_one),
+                tuple(state.run_one), state.log_p, time_step)
+
+    def formation_key(self, state):
+        """
+        Everything the moves of state depend on: offense nodes, ball holder
+        and screen_one / run_one in order. Not the defense, log_p or depth.
+        """
+        nodes = tuple(state.get_agent_node(i) for i in range(int(state.n_agent / 2)))
+        return (nodes, state.ball_agent_id, tuple(state.screen_one), tuple(state.run_one))
+
+    def get_moves(self, state):
+        """
+        iter_moves of state as compact moves (see compact_move), from an
+        LRU cache keyed by formation_key. The cache holds at most
+        move_cache_size moves; a formation with more than a tenth of that
+        is not cached, so one formation can't push out many others.
+        Compact moves are tuples of numbers only, which the garbage
+        collector stops tracking, so a full cache costs full collections
+        nothing.
+
+        Returns
+        -------
+        moves: tuple of compact moves
+            in iter_moves order
+        """
+        if self.move_cache_size <= 0:
+            return tuple(self.compact_move(state, move) for move in self.iter_moves(state))
+        if self.move_cache_links is not state.stand_place_pairs:
+            # move lists are only valid for one stand place graph
+            self.move_cache.clear()
+            self.move_cache_moves = 0
+            self.move_cache_links = state.stand_place_pairs
+        key = self.formation_key(state)
+        moves = self.move_cache.get(key)
+        if moves is not None:
+            self.move_cache.move_to_end(key)
+            self.move_cache_hits += 1
+            if self.stats is not None:
+                self.stats.count("move_cache_hits")
+            return moves
+        self.move_cache_misses += 1
+        if self.stats is not None:
+            self.stats.count("move_cache_misses")
+        moves = tuple(self.compact_move(state, move) for move in self.iter_moves(state))
+        if len(moves) > self.move_cache_size // 10:
+            self.move_cache_evictions += 1
+            return moves
+        self.move_cache[key] = moves
+        self.move_cache_moves += len(moves)
+        while self.move_cache_moves > self.move_cache_size:
+            _, old = self.move_cache.popitem(last=False)
+            self.move_cache_moves -= len(old)
+            self.move_cache_evictions += 1
+        return moves
+
+    def warm_up(self, state, max_formations=None):
+        """
+        Fill the move cache with every formation reachable from state on
+        the stand place graph, breadth first, until the cache is full or
+        max_formations (None for no limit) are cached. state is not changed.
+
+        Returns
+        -------
+        n_formation: int
+            formations visited
+        """
+        if max_formations is None:
+            max_formations = float("inf")
+        work = copy.copy(state)
+        work.my_deep_copy()
+        seen = {self.formation_key(work)}
+        queue = [work.compact()]
+        i = 0
+        while i < len(queue):
+            work.set_compact(queue[i])
+            i += 1
+            n_eviction = self.move_cache_evictions
+            moves = self.get_moves(work)
+            if self.move_cache_evictions > n_eviction:
+                # full, more formations would only push out the nearest ones
+                break
+            if len(seen) >= max_formations:
+                continue
+            for move in moves:
+                token = self.apply(work, move)
+                key = self.formation_key(work)
+                if key not in seen and len(seen) < max_formations:
+                    seen.add(key)
+                    queue.append(work.compact())
+                self.undo(work, token)
+        # the hit rate is about searches, not the warm-up
+        self.move_cache_hits = 0
+        self.move_cache_misses = 0
+        return i
+
+    def move_cache_info(self):
+        """
+        Returns
+        -------
+        info: dict
+            formations and moves cached, approximate bytes (keys and
+            compact moves, not the shared small ints), evictions, hits,
+            misses and hit rate
+        """
+        n_move = 0
+        size = sys.getsizeof(self.move_cache)
+        for key, moves in self.move_cache.items():
+            size += sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(moves)
+            for move in moves:
+                size += sys.getsizeof(move) + sum(sys.getsizeof(part) for part in move)
+            n_move += len(moves)
+        n_lookup = self.move_cache_hits + self.move_cache_misses
+        return {"formations": len(self.move_cache), "moves": n_move, "bytes": size,
+                "evictions": self.move_cache_evictions,
+                "hits": self.move_cache_hits, "misses": self.move_cache_misses,
+                "hit_rate": self.move_cache_hits / n_lookup if n_lookup else 0.}
+
+    def iter_moves(self, state):
+        """
+        Lazy version of refine_possible_moves(get_step_1_moves(state)):
+        yields the same moves in the same order. One working move dict is
+        changed and restored on the way down and only copied when a
+        complete move is yielded, and the refine constraints (no two
+        screens for the same agent, no two non-screening agents on one
+        place) cut partial moves as soon as they are violated.
+        """
+        n_offense = int(state.n_agent / 2)
+        move = {"pass": {}, "screen": {}, "go": {}}
+
+        # build white list that could move freely
+        white_list = 0  # bit mask of agent ids
+        for agent_id in range(n_offense):
+            if agent_id == state.ball_agent_id:
+                continue
+            if agent_id in state.screen_one:
+                continue
+            white_list |= 1 << agent_id
+
+        # case 1: not pass
+        yield from self._iter_step_2(state, move, white_list, 0, set())
+        # case 2: find if someone could pass
+        ball_agent_id = state.ball_agent_id
+        n1 = state.get_agent_node(ball_agent_id)
+        for agent_id in range(n_offense):
+            if not white_list >> agent_id & 1:
+                continue
+            if agent_id in state.run_one:  # screen_one need to run
+                continue
+            if state.is_linked(n1, state.get_agent_node(agent_id)):
+                move["pass"][ball_agent_id] = agent_id
+                new_white_list = (white_list | 1 << ball_agent_id) & ~(1 << agent_id)
+                yield from self._iter_step_2(state, move, new_white_list, 0, set())
+                del move["pass"][ball_agent_id]
+
+    def _iter_step_2(self, state, move, white_list, pass_list, screened):
+        """screens of iter_moves, screened holds the agents already screened for"""
+        n_offense = int(state.n_agent / 2)
+        for agent_id_1 in range(n_offense):
+            if not white_list >> agent_id_1 & 1 or pass_list >> agent_id_1 & 1:
+                continue
+            # case 1.1 agent_id_1 choose to pass this round
+            yield from self._iter_step_2(state, move, white_list,
+                                         pass_list | 1 << agent_id_1, screened)
+            # case 1.2 agent_id_1 screen for someone
+            n1 = state.get_agent_node(agent_id_1)
+            for agent_id_2 in range(n_offense):
+                if not white_list >> agent_id_2 & 1 or agent_id_2 == agent_id_1:
+                    continue
+                if not state.is_linked(n1, state.get_agent_node(agent_id_2)):
+                    continue
+                if agent_id_2 in screened:
+                    if self.stats is not None:
+                        self.stats.count("moves_cut")
+                    continue
+                move["screen"][agent_id_1] = agent_id_2
+                screened.add(agent_id_2)
+                yield from self._iter_step_2(
+                    state, move, white_list & ~(1 << agent_id_1 | 1 << agent_id_2),
+                    pass_list, screened)
+                screened.remove(agent_id_2)
+                del move["screen"][agent_id_1]
+            # state.screen_one could also be agent_id_2
+            for agent_id_2 in state.screen_one:
+                if white_list >> agent_id_2 & 1 or agent_id_2 == agent_id_1:
+                    continue
+                if not state.is_linked(n1, state.get_agent_node(agent_id_2)):
+                    continue
+                if agent_id_2 in screened:
+                    if self.stats is not None:
+                        self.stats.count("moves_cut")
+                    continue
+                move["screen"][agent_id_1] = agent_id_2
+                screened.add(agent_id_2)
+                yield from self._iter_step_2(
+                    state, move, white_list & ~(1 << agent_id_1), pass_list, screened)
+                screened.remove(agent_id_2)
+                del move["screen"][agent_id_1]
+            return
+
+        # agents that neither screen nor stay free keep their place
+        same_place = {}
+        for agent_id in range(n_offense):
+            if agent_id in move["screen"] or white_list >> agent_id & 1:
+                continue
+            node = state.get_agent_node(agent_id)
+            if node in same_place:
+                if self.stats is not None:
+                    self.stats.count("moves_cut")
+                return
+            same_place[node] = agent_id
+        yield from self._iter_step_3(state, move, white_list, 0, same_place)
+
+    def _iter_step_3(self, state, move, white_list, pass_list, same_place):
+        """goes of iter_moves, same_place maps taken nodes to their agent"""
+        n_offense = int(state.n_agent / 2)
+        for agent_id_1 in range(n_offense):
+            if not white_list >> agent_id_1 & 1 or pass_list >> agent_id_1 & 1:
+                continue
+            # case 1.1 agent_id_1 choose to pass this round
+            n1 = state.get_agent_node(agent_id_1)
+            if n1 not in same_place:
+                same_place[n1] = agent_id_1
+                yield from self._iter_step_3(state, move, white_list,
+                                             pass_list | 1 << agent_id_1, same_place)
+                del same_place[n1]
+            elif self.stats is not None:
+                self.stats.count("moves_cut")
+            # case 1.2 agent_id_1 choose to run
+            for n2 in state.get_linked_nodes(n1):
+                if n2 in same_place:
+                    if self.stats is not None:
+                        self.stats.count("moves_cut")
+                    continue
+                move["go"][agent_id_1] = state.position.node_vpos(n2)
+                same_place[n2] = agent_id_1
+                yield from self._iter_step_3(state, move, white_list & ~(1 << agent_id_1),
+                                             pass_list, same_place)
+                del same_place[n2]
+                del move["go"][agent_id_1]
+            return
+        yield {"pass": dict(move["pass"]), "screen": dict(move["screen"]),
+               "go": dict(move["go"])}
 
     def get_step_1_moves(self, state):
         """
@@ -198,18 +1211,20 @@ class MotionOffense(Strategy):
         ret.extend(self.get_step_2_moves(state, new_move, new_white_list, set()))
         # case 2: find if someone could pass
         ball_agent_id = state.ball_agent_id
-        v1 = state.get_agent_virtual_pos(ball_agent_id)
+        n1 = state.get_agent_node(ball_agent_id)
         for agent_id in white_list:
             if agent_id in state.run_one:  # screen_one need to run
                 continue
-            v2 = state.get_agent_virtual_pos(agent_id)
-            if v2 in state.stand_place_link[str(v1)]:
+            n2 = state.get_agent_node(agent_id)
+            if state.is_linked(n1, n2):
                 new_move = copy.deepcopy(move)
                 new_move["pass"][ball_agent_id] = agent_id
                 new_white_list = copy.deepcopy(white_list)
                 new_white_list.add(ball_agent_id)
                 new_white_list.remove(agent_id)
                 ret.extend(self.get_step_2_moves(state, new_move, new_white_list, set()))
+        if self.stats is not None:
+            self.stats.count("moves_generated", len(ret))
         return ret
 
     def get_step_2_moves(self, state, move, white_list, pass_list):
@@ -227,12 +1242,12 @@ class MotionOffense(Strategy):
             ret.extend(self.get_step_2_moves(state, new_move, new_white_list, new_pass_list))
             further_search = True
             # case 1.2 agent_id_1 screen for someone
+            n1 = state.get_agent_node(agent_id_1)
             for agent_id_2 in white_list:
                 if agent_id_2 == agent_id_1:
                     continue
-                v1 = state.get_agent_virtual_pos(agent_id_1)
-                v2 = state.get_agent_virtual_pos(agent_id_2)
-                if v2 not in state.stand_place_link[str(v1)]:
+                n2 = state.get_agent_node(agent_id_2)
+                if not state.is_linked(n1, n2):
                     continue
                 new_move = copy.deepcopy(move)
                 new_move["screen"][agent_id_1] = agent_id_2
@@ -248,15 +1263,9 @@ class MotionOffense(Strategy):
                     continue
                 if agent_id_2 == agent_id_1:
                     continue
-                v1 = state.get_agent_virtual_pos(agent_id_1)
-                v2 = state.get_agent_virtual_pos(agent_id_2)
-                if v2 not in state.stand_place_link[str(v1)]:
+                n2 = state.get_agent_node(agent_id_2)
+                if not state.is_linked(n1, n2):
                     continue
-                print(state.screen_one)
-                print(state.run_one)
-                print(new_move)
-                print(new_white_list)
-                print(new_pass_list)
                 new_move = copy.deepcopy(move)
                 new_move["screen"][agent_id_1] = agent_id_2
                 new_white_list = copy.deepcopy(white_list)
@@ -287,10 +1296,10 @@ class MotionOffense(Strategy):
             ret.extend(self.get_step_3_moves(state, new_move, new_white_list, new_pass_list))
             further_search = True
             # case 1.2 agent_id_1 choose to run
-            v1 = state.get_agent_virtual_pos(agent_id_1)
-            for v2 in state.stand_place_link[str(v1)]:
+            n1 = state.get_agent_node(agent_id_1)
+            for n2 in state.get_linked_nodes(n1):
                 new_move = copy.deepcopy(move)
-                new_move["go"][agent_id_1] = v2
+                new_move["go"][agent_id_1] = state.position.node_vpos(n2)
                 new_white_list = copy.deepcopy(white_list)
                 new_white_list.remove(agent_id_1)
                 new_pass_list = copy.deepcopy(pass_list)
@@ -321,14 +1330,16 @@ class MotionOffense(Strategy):
                 if agent_id in move["screen"]:
                     continue
                 if agent_id not in move["go"]:
-                    vpos = state.get_agent_virtual_pos(agent_id)
+                    node = state.get_agent_node(agent_id)
                 else:
-                    vpos = move["go"][agent_id]
-                if str(vpos) in same_place:
+                    node = state.position.node_id(move["go"][agent_id])
+                if node in same_place:
                     ok = False
-                same_place.add(str(vpos))
+                same_place.add(node)
             if ok:
                 new_moves.append(move)
+        if self.stats is not None:
+            self.stats.count("moves_refined_away", len(moves) - len(new_moves))
         return new_moves
 
     def get_reward(self, state, move):
@@ -337,38 +1348,95 @@ class MotionOffense(Strategy):
         if len(move["pass"]) > 0:
             for x in move["pass"]:  # only one x
                 ball_agent_id = move["pass"][x]
-        v1 = state.get_agent_virtual_pos(ball_agent_id)
+        n1 = state.get_agent_node(ball_agent_id)
         for agent_id in move["go"]:
-            v2 = move["go"][agent_id]
-            if v2 in state.stand_place_link[str(v1)]:
+            n2 = state.position.node_id(move["go"][agent_id])
+            if state.is_linked(n1, n2):
                 if agent_id in state.run_one:
                     log_p += math.log(self.p_screen)
                 else:
                     log_p += math.log(self.p_unscreen)
         return log_p
 
+    def compact_move(self, state, move, reward=None):
+        """
+        Immutable form of a move dict, what get_moves and the searches use.
+        reward is get_reward(state, move) if already known.
+
+        Returns
+        -------
+        move: tuple
+            (reward, pass, screen, go): pass is () or (from, to) agent ids,
+            screen the (agent_id_1, agent_id_2) pairs and go the
+            (agent_id, node id) pairs of the dict, flattened, in its order
+        """
+        if reward is None:
+            reward = self.get_reward(state, move)
+        pass_ = next(iter(move["pass"].items()), ())
+        screen = tuple(agent_id for pair in move["screen"].items() for agent_id in pair)
+        node_id = state.position.node_id
+        go = tuple(x for agent_id, vpos in move["go"].items() for x in (agent_id, node_id(vpos)))
+        return (reward, pass_, screen, go)
+
+    def expand_move(self, state, move):
+        """move dict of a compact move"""
+        _, pass_, screen, go = move
+        node_vpos = state.position.node_vpos
+        return {"pass": dict([pass_]) if pass_ else {},
+                "screen": dict(zip(screen[::2], screen[1::2])),
+                "go": {go[k]: node_vpos(go[k + 1]) for k in range(0, len(go), 2)}}
+
     def get_successor_state(self, state, move):
+        if self.stats is not None:
+            self.stats.count("successor_copies")
         new_state = copy.copy(state)
         new_state.my_deep_copy()
+        self.apply(new_state, move)
+        return new_state
+
+    def apply(self, state, move, reward=None):
         """
-        self.agents = copy.deepcopy(self.agents)
-        self.screen_one = copy.deepcopy(self.screen_one)
-        self.run_one = copy.deepcopy(self.run_one)
+        In-place get_successor_state of a move dict or a compact move.
+        state.screen_one and state.run_one are replaced by new lists,
+        never changed in place, so iterators over the old lists stay valid
+        until undo(). reward is get_reward(state, move) of a move dict if
+        already known; compact moves carry theirs.
+
+        Returns
+        -------
+        token: tuple
+            pass to undo() to restore state
         """
-        if len(move["pass"]) > 0:
-            for x in move["pass"]:  # only one x
-                new_state.ball_agent_id = move["pass"][x]
-        new_state.screen_one = []
-        new_state.run_one = []
-        for agent_id_1, agent_id_2 in move["screen"].items():
-            new_state.screen_one.append(agent_id_1)
-            new_state.run_one.append(agent_id_2)
-            vpos = state.get_agent_virtual_pos(agent_id_2)
-            new_state.move_agent_to(agent_id_1, vpos)
-        for agent_id_1, vpos in move["go"].items():
-            new_state.move_agent_to(agent_id_1, vpos)
-        new_state.log_p += self.get_reward(state, move)
-        return new_state
+        if isinstance(move, dict):
+            move = self.compact_move(state, move, reward)
+        reward, pass_, screen, go = move
+        moved = []
+        targets = []
+        for k in range(0, len(screen), 2):
+            targets.append((screen[k], state.get_agent_node(screen[k + 1])))
+        for k in range(0, len(go), 2):
+            targets.append((go[k], go[k + 1]))
+        token = (state.ball_agent_id, state.screen_one, state.run_one, state.log_p, moved)
+
+        if pass_:
+            state.ball_agent_id = pass_[1]
+        state.screen_one = list(screen[::2])
+        state.run_one = list(screen[1::2])
+        for agent_id, node in targets:
+            agent = state.agents[agent_id]
+            moved.append((agent_id, agent.virtual_pos, agent.node))
+            state.move_agent_to_node(agent_id, node)
+        state.log_p += reward
+        return token
+
+    def undo(self, state, token):
+        ball_agent_id, screen_one, run_one, log_p, moved = token
+        state.ball_agent_id = ball_agent_id
+        state.screen_one = screen_one
+        state.run_one = run_one
+        state.log_p = log_p
+        for agent_id, virtual_pos, node in reversed(moved):
+            state.set_agent_pos(agent_id, virtual_pos, node)
 
     """
     def get_successor_state(self, agent_id, move):
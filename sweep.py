@@ -0,0 +1,211 @@
+"""
+Parameter sweep of MotionOffense over p_screen, p_unscreen, time_step and
+starting formations, spread over a process pool.
+
+Every combination of the grid and a scenario of the scenario file (see
+headless.py for the format) is one run: a MotionOffense play of time_step
+steps. Finished runs are appended to the output as JSON lines right away,
+so a crashed or stopped sweep continues where it stopped when started
+again with the same output file.
+
+Workers don't rebuild the court: the parent writes each court to the
+geometry cache once and workers memory-map it (see geometry_cache), so
+the path tables are shared read-only between all processes.
+
+    python sweep.py plays.json -o sweep.jsonl --p_screen 0.1 0.2 0.3 \\
+        --p_unscreen 0.7 0.8 0.9 --time_step 1 2 3 --jobs 8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import geometry_cache
+import headless
+from state import Position
+from strategy import MotionOffense
+
+# per worker process: scenarios and their states, see _init_worker
+_scenarios = None
+_states = {}
+_cache_dir = None
+
+
+def make_runs(n_scenario, p_screens, p_unscreens, time_steps):
+    """
+    Returns
+    -------
+    runs: list of dict
+        every combination of scenario index and grid values
+    """
+    runs = []
+    for p_screen, p_unscreen, time_step, scenario in itertools.product(
+            p_screens, p_unscreens, time_steps, range(n_scenario)):
+        runs.append({"scenario": scenario, "p_screen": p_screen,
+                     "p_unscreen": p_unscreen, "time_step": time_step})
+    return runs
+
+
+def run_key(run):
+    return (run["scenario"], run["p_screen"], run["p_unscreen"], run["time_step"])
+
+
+def read_done(path):
+    """
+    Keys of the runs already in the output file. A partly written last
+    line, left by a crash, is cut off so that new results append cleanly.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    valid_size = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            done.add(run_key(record))
+            valid_size += len(line)
+    if valid_size != os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(valid_size)
+    return done
+
+
+def prepare_geometry(scenarios, cache_dir):
+    """build every court of scenarios once and store it in cache_dir"""
+    courts = set()
+    for scenario in scenarios:
+        court = scenario["court"]
+        courts.add((tuple(court["rect"]), court["x_offset"], court["y_offset"], court["factor"]))
+    for rect, x_offset, y_offset, factor in courts:
+        Position(list(rect), x_offset, y_offset, factor, cache_dir=cache_dir)
+
+
+def _init_worker(scenarios, cache_dir):
+    global _scenarios, _states, _cache_dir
+    _scenarios = scenarios
+    _states = {}
+    _cache_dir = cache_dir
+
+
+def run_one(run, search="bounded"):
+    """play one run in this process, returns its record"""
+    i = run["scenario"]
+    if i not in _states:
+        _states[i] = headless.make_state(_scenarios[i], _cache_dir)
+    else:
+        headless.reset_state(_states[i], _scenarios[i])
+    offense = MotionOffense(run["p_screen"], run["p_unscreen"], search=search)
+    start = time.perf_counter()
+    record = headless.run_possession(_states[i], offense, None, run["time_step"])
+    record["elapsed"] = time.perf_counter() - start
+    record["nodes"] = offense.node_count
+    record.update(run)
+    return record
+
+
+def sweep(scenarios, runs, output, jobs=1, search="bounded", cache_dir=None,
+          progress=sys.stderr, progress_interval=5.):
+    """
+    Play the runs not yet in output and append their records to it.
+
+    Parameters
+    ---------
+    runs: list of dict
+        from make_runs()
+    output: str
+        JSON lines file, read first to skip finished runs
+    jobs: int
+        worker processes, 1 plays the runs in this process
+    cache_dir: str or None
+        geometry cache shared with the workers, a temporary one if None
+    Returns
+    -------
+    n_done: int
+        runs played by this call
+    """
+    done = read_done(output)
+    todo = [run for run in runs if run_key(run) not in done]
+    if progress is not None and done:
+        print("resuming: {} of {} runs already in {}".format(
+            len(runs) - len(todo), len(runs), output), file=progress)
+
+    tmp_dir = None
+    if cache_dir is None:
+        tmp_dir = cache_dir = tempfile.mkdtemp(prefix="sweep_geometry_")
+    prepare_geometry(scenarios, cache_dir)
+
+    start = time.perf_counter()
+    last_report = start
+    n_done = 0
+    with open(output, "a") as out:
+        def write(record):
+            nonlocal n_done, last_report
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            n_done += 1
+            now = time.perf_counter()
+            if progress is not None and (now - last_report >= progress_interval
+                                         or n_done == len(todo)):
+                last_report = now
+                rate = n_done / max(now - start, 1e-9)
+                print("{}/{} runs  {:.2f} runs/s  eta {:.0f} s".format(
+                    n_done, len(todo), rate, (len(todo) - n_done) / rate), file=progress)
+
+        try:
+            if jobs <= 1:
+                _init_worker(scenarios, cache_dir)
+                for run in todo:
+                    write(run_one(run, search))
+            else:
+                with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                         initargs=(scenarios, cache_dir)) as pool:
+                    # keep a few runs per worker in flight, not the whole grid
+                    pending = set()
+                    runs_left = iter(todo)
+                    for run in itertools.islice(runs_left, 4 * jobs):
+                        pending.add(pool.submit(run_one, run, search))
+                    while pending:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            write(future.result())
+                            for run in itertools.islice(runs_left, 1):
+                                pending.add(pool.submit(run_one, run, search))
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    return n_done
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="MotionOffense parameter sweep")
+    parser.add_argument("scenario", help="scenario JSON file, see headless.py")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSON lines result file, appended to and used to resume")
+    parser.add_argument("--p_screen", type=float, nargs="+", default=[0.2])
+    parser.add_argument("--p_unscreen", type=float, nargs="+", default=[0.8])
+    parser.add_argument("--time_step", type=int, nargs="+", default=[2])
+    parser.add_argument("--search", choices=["exhaustive", "bounded", "beam"], default="bounded")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--cache_dir", default=geometry_cache.DEFAULT_CACHE_DIR,
+                        help="court geometry cache directory shared by the workers, "
+                             "'' for a temporary one")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    scenarios = headless.load_scenarios(args.scenario)
+    runs = make_runs(len(scenarios), args.p_screen, args.p_unscreen, args.time_step)
+    start = time.perf_counter()
+    n = sweep(scenarios, runs, args.output, args.jobs, args.search, args.cache_dir or None)
+    print("{} runs in {:.3f} s".format(n, time.perf_counter() - start), file=sys.stderr)
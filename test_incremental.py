@@ -0,0 +1,41 @@
+"""
+Incremental occupancy and features of State against full recomputation,
+on random walks of agent moves, MotionOffense moves, undos, copies and
+set_compact (benchmark.verify_incremental).
+
+    python -m pytest test_incremental.py
+    python test_incremental.py
+"""
+import random
+
+from benchmark import make_formation, check_incremental, verify_incremental
+from strategy import Minimax
+
+
+def test_random_walks():
+    verify_incremental([6, 10], n_walk=100)
+
+
+def test_leaf_values_match_apply():
+    """batched leaves read the node apply() moves to, without applying"""
+    rng = random.Random(0)
+    minimax = Minimax()
+    for seed in range(8):
+        state = make_formation(10, seed)
+        for _ in range(20):
+            agent_id = rng.randrange(state.n_agent)
+            moves = state.get_legal_moves()
+            values = minimax.leaf_values(agent_id, state, moves)
+            expected = []
+            for move in moves:
+                token = state.apply(agent_id, move)
+                expected.append(minimax.evaluation_function(state))
+                state.undo(token)
+            assert values == expected
+            check_incremental(state, rng)
+            state.apply(agent_id, rng.choice(moves))
+
+
+if __name__ == "__main__":
+    test_random_walks()
+    test_leaf_values_match_apply()
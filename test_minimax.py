@@ -0,0 +1,53 @@
+"""
+Minimax: alpha_beta_search, with and without batched leaves and with a
+time budget, returns the full_width_search result at equal depth.
+
+    python -m pytest test_minimax.py
+    python test_minimax.py
+"""
+from benchmark import make_formation
+from strategy import Minimax
+
+
+def positions(state):
+    return [agent.get_virtual_pos() for agent in state.agents]
+
+
+def test_alpha_beta_matches_full_width():
+    for n_agent, depths in ((6, (1, 2, 3, 4)), (10, (1, 2, 3))):
+        for seed in range(3):
+            for depth in depths:
+                for agent_id in (0, n_agent - 1):
+                    state = make_formation(n_agent, seed)
+                    before = positions(state)
+                    expected = Minimax(alpha_beta=False).full_width_search(agent_id, state, depth)
+                    for batch_leaves in (False, True):
+                        minimax = Minimax(batch_leaves=batch_leaves)
+                        # batch below batch_min_agent too
+                        minimax.batch_min_agent = 0
+                        assert minimax.alpha_beta_search(agent_id, state, depth) == expected
+                        assert minimax.next_move(agent_id, state, depth) == expected[1]
+                    assert positions(state) == before
+
+
+def test_time_budget():
+    for seed in range(3):
+        state = make_formation(6, seed)
+        before = positions(state)
+        expected = Minimax(alpha_beta=False).full_width_search(0, state, 3)
+        # a budget that lets every depth finish gives the full-depth result
+        minimax = Minimax()
+        assert minimax.alpha_beta_search(0, state, 3, time_budget=60.) == expected
+        assert minimax.completed_depth == 3
+        # a budget that runs out keeps the deepest completed depth
+        minimax = Minimax()
+        s, move = minimax.alpha_beta_search(0, state, 12, time_budget=0.05)
+        assert 1 <= minimax.completed_depth < 12
+        assert (s, move) == Minimax(alpha_beta=False).full_width_search(
+            0, state, minimax.completed_depth)
+        assert positions(state) == before
+
+
+if __name__ == "__main__":
+    test_alpha_beta_matches_full_width()
+    test_time_budget()
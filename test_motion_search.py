@@ -0,0 +1,42 @@
+"""
+MotionOffense: bounded search and the exhaustive search with its
+transposition table and move cache give the (move, log_p) of the plain
+exhaustive search, for several formations, depths and probability pairs.
+
+    python -m pytest test_motion_search.py
+    python test_motion_search.py
+"""
+from benchmark import make_formation
+from strategy import MotionOffense
+
+# p_screen < p_unscreen, equal, and p_screen > p_unscreen
+PROBABILITIES = ((0.2, 0.8), (0.5, 0.5), (0.8, 0.2), (0.9, 0.4))
+
+
+def formations(offense, n_agent, seeds):
+    """make_formation, and its successor after a screen (run_one set)"""
+    for seed in seeds:
+        state = make_formation(n_agent, seed)
+        yield state
+        for move in offense.iter_moves(state):
+            if move["screen"]:
+                yield offense.get_successor_state(state, move)
+                break
+
+
+def test_same_result_as_plain():
+    for p_screen, p_unscreen in PROBABILITIES:
+        plain = MotionOffense(p_screen, p_unscreen, transposition_size=0, move_cache_size=0)
+        # reused across formations and depths, so entries of earlier searches are hit
+        cached = MotionOffense(p_screen, p_unscreen)
+        bounded = MotionOffense(p_screen, p_unscreen, search="bounded")
+        for state in formations(plain, 6, range(2)):
+            for depth in (1, 2, 3):
+                expected = plain.next_move(state, depth)
+                assert cached.next_move(state, depth) == expected
+                assert bounded.next_move(state, depth) == expected
+        assert cached.cache_hits > 0 and cached.move_cache_hits > 0
+
+
+if __name__ == "__main__":
+    test_same_result_as_plain()
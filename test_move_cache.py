@@ -0,0 +1,68 @@
+"""
+MotionOffense move cache: bounded memory, hits on 10-agent formations and
+the same moves as without it.
+
+    python -m pytest test_move_cache.py
+    python test_move_cache.py
+"""
+import tracemalloc
+
+from benchmark import make_formation
+from strategy import MotionOffense
+
+
+def check_bounded(offense):
+    size = offense.move_cache_size
+    assert offense.move_cache_moves <= size
+    assert offense.move_cache_moves == sum(len(moves) for moves in offense.move_cache.values())
+    assert all(len(moves) <= size // 10 for moves in offense.move_cache.values())
+    assert offense.move_cache_info()["bytes"] < 400 * size
+
+
+def test_memory_bounded_10_agents():
+    size = 20000
+    offense = MotionOffense(0.2, 0.8, search="beam", beam_width=4, move_cache_size=size)
+    # seed 0 has enough small formations to fill the cache
+    state = make_formation(10, 0)
+    tracemalloc.start()
+    try:
+        offense.warm_up(state)
+        offense.next_move(state, 2)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert offense.move_cache_evictions > 0
+    check_bounded(offense)
+    # about 300 B per cached move, plus the search itself
+    assert peak < 32 * 1024 * 1024
+    for seed in (1, 2):
+        state = make_formation(10, seed)
+        offense.warm_up(state)
+        offense.next_move(state, 2)
+        check_bounded(offense)
+
+
+def test_hits_10_agents():
+    offense = MotionOffense(0.2, 0.8, search="beam", beam_width=4)
+    for seed in range(3):
+        offense.next_move(make_formation(10, seed), 3)
+    info = offense.move_cache_info()
+    assert info["formations"] > 0
+    assert info["hit_rate"] > 0.2
+    check_bounded(offense)
+
+
+def test_same_moves_as_uncached():
+    for n_agent, kwargs, depth in ((6, dict(search="bounded"), 3),
+                                   (10, dict(search="beam", beam_width=4), 2)):
+        cached = MotionOffense(0.2, 0.8, **kwargs)
+        uncached = MotionOffense(0.2, 0.8, move_cache_size=0, **kwargs)
+        for seed in range(3):
+            state = make_formation(n_agent, seed)
+            assert cached.next_move(state, depth) == uncached.next_move(state, depth)
+
+
+if __name__ == "__main__":
+    test_memory_bounded_10_agents()
+    test_hits_10_agents()
+    test_same_moves_as_uncached()
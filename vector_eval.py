@@ -0,0 +1,184 @@
+"""
+NumPy version of State.defense_distance, State.basket_distance and
+State.is_open for all offense agents of many states at once.
+
+Real coordinates are computed with the arithmetic of
+Position.virtual_to_real, so they are the same floats as in the scalar
+code. Distances are compared with np.sqrt, which can differ from the
+pow() of Position.real_distance in the last bit; wherever that could
+change a result (two defenders at nearly the same distance, a basket
+distance next to the three point line) the pow() values decide, so the
+nearest defender and the open flags always equal the scalar ones. With
+exact=True the returned distances are the pow() values as well.
+"""
+import math
+
+import numpy as np
+
+REAL_THREE_POINT = 6.75
+# relative gap below which the sqrt and pow() distances may order differently
+TOLERANCE = 1e-12
+
+
+def _real_distance(a, b):
+    """Position.real_distance on real coordinates"""
+    diff_x = a[0] - b[0]
+    diff_y = a[1] - b[1]
+    return pow(pow(diff_x, 2) + pow(diff_y, 2), 0.5)
+
+
+def real_coordinates(position, vpos):
+    """virtual positions (..., 2) to real coordinates (..., 2)"""
+    vpos = np.asarray(vpos, dtype=float)
+    real = np.empty(vpos.shape)
+    real[..., 0] = vpos[..., 0] * math.sqrt(3) / 2 * position.factor + position.x_offset
+    real[..., 1] = vpos[..., 1] / 2 * position.factor + position.y_offset
+    return real
+
+
+def stack_states(states):
+    """real coordinates (n_state, n_agent, 2) of the agents of states on one court"""
+    vpos = [[agent.virtual_pos for agent in state.agents] for state in states]
+    return real_coordinates(states[0].position, vpos)
+
+
+def evaluate(real, real_basket, n_offense, exact=True):
+    """
+    Parameters
+    ---------
+    real: array (n_state, n_agent, 2)
+        real coordinates, offense agents first
+    real_basket: array (2,)
+    exact: bool
+        return the pow() distances of the scalar code, otherwise the
+        np.sqrt ones (the defender ids and open flags are exact anyway)
+    Returns
+    -------
+    min_distance: array (n_state, n_offense)
+        distance to the nearest defender on the basket side, -1 if none
+    min_agent_id: array (n_state, n_offense)
+        agent id of that defender, -1 if none
+    basket_distance: array (n_state, n_offense)
+    is_open: bool array (n_state, n_offense)
+    """
+    real = np.asarray(real, dtype=float)
+    real_basket = np.asarray(real_basket, dtype=float)
+    offense = real[:, :n_offense]
+    defense = real[:, n_offense:]
+
+    vector_off = real_basket - offense  # (n, o, 2)
+    vector_def = defense[:, None, :, :] - offense[:, :, None, :]  # (n, o, d, 2)
+    basket_side = (vector_off[:, :, None, 0] * vector_def[..., 0]
+                   + vector_off[:, :, None, 1] * vector_def[..., 1]) > 0
+    diff = offense[:, :, None, :] - defense[:, None, :, :]
+    distance = np.sqrt(diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1])
+    distance = np.where(basket_side, distance, np.inf)
+
+    index = distance.argmin(axis=2)
+    min_distance = np.take_along_axis(distance, index[..., None], axis=2)[..., 0]
+    found = np.isfinite(min_distance)
+    near = distance <= (min_distance * (1 + TOLERANCE))[..., None]
+    for s, o in zip(*np.nonzero(found & (near.sum(axis=2) > 1))):
+        # near tie: the first defender with the smallest pow() distance wins
+        best = None
+        for j in np.nonzero(near[s, o])[0]:
+            d = _real_distance(offense[s, o].tolist(), defense[s, j].tolist())
+            if best is None or d < best:
+                best = d
+                index[s, o] = j
+
+    basket_distance = _basket_distance(offense, real_basket, exact)
+    if exact:
+        for s, o in zip(*np.nonzero(found)):
+            min_distance[s, o] = _real_distance(offense[s, o].tolist(),
+                                                defense[s, index[s, o]].tolist())
+
+    min_distance = np.where(found, min_distance, -1.)
+    min_agent_id = np.where(found, index + n_offense, -1)
+    is_open = (basket_distance < REAL_THREE_POINT + 1) & ~found
+    return min_distance, min_agent_id, basket_distance, is_open
+
+
+def _basket_distance(offense, real_basket, exact):
+    """
+    State.basket_distance of offense (n, o, 2), the pow() value where it
+    decides a comparison with the three point line + 1, or everywhere
+    when exact
+    """
+    diff = offense - real_basket
+    basket_distance = np.sqrt(diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1])
+    threshold = REAL_THREE_POINT + 1
+    if exact:
+        unsure = np.ones(basket_distance.shape, dtype=bool)
+    else:
+        unsure = np.abs(basket_distance - threshold) <= threshold * TOLERANCE
+    for s, o in zip(*np.nonzero(unsure)):
+        basket_distance[s, o] = _real_distance(offense[s, o].tolist(), real_basket.tolist())
+    return basket_distance
+
+
+def evaluation_values(real, real_basket, n_offense):
+    """
+    Minimax.evaluation_function of stacked states: -10000 for every
+    offense agent outside the three point line + 1, +1000 for every open
+    one
+
+    Returns
+    -------
+    values: int array (n_state,)
+    """
+    real = np.asarray(real, dtype=float)
+    offense = real[:, :n_offense]
+    defense = real[:, n_offense:]
+    # only whether a defender is on the basket side matters, not which one
+    vector_off = real_basket - offense
+    vector_def = defense[:, None, :, :] - offense[:, :, None, :]
+    covered = ((vector_off[:, :, None, 0] * vector_def[..., 0]
+                + vector_off[:, :, None, 1] * vector_def[..., 1]) > 0).any(axis=2)
+    basket_distance = _basket_distance(offense, real_basket, False)
+    far = basket_distance > REAL_THREE_POINT + 1
+    is_open = (basket_distance < REAL_THREE_POINT + 1) & ~covered
+    return -10000 * far.sum(axis=1) + 1000 * is_open.sum(axis=1)
+
+
+class LeafEvaluator:
+    """
+    evaluation_values of leaves given by agent node ids, with the real
+    coordinates of every node of the court cached in one array
+    """
+    def __init__(self, position, real_basket):
+        self.position = position
+        self.real_pos = np.array(position.real_pos, dtype=float).reshape(-1, 2)
+        self.real_basket = np.asarray(real_basket, dtype=float)
+
+    def evaluate_nodes(self, nodes, n_offense):
+        """
+        Parameters
+        ---------
+        nodes: int array (n_leaf, n_agent)
+        Returns
+        -------
+        values: list of int
+        """
+        real = self.real_pos[np.asarray(nodes)]
+        return evaluation_values(real, self.real_basket, n_offense).tolist()
+
+
+def evaluate_states(states, exact=True):
+    """evaluate() of states, all on one court with the same n_agent"""
+    state = states[0]
+    real_basket = state.position.virtual_to_real(state.get_basket_virtual_pos())
+    return evaluate(stack_states(states), real_basket, int(state.n_agent / 2), exact)
+
+
+def defense_distance(state, agent_id):
+    """State.defense_distance through evaluate()"""
+    min_distance, min_agent_id, _, _ = evaluate_states([state])
+    if min_agent_id[0, agent_id] < 0:
+        return -1, None
+    return float(min_distance[0, agent_id]), int(min_agent_id[0, agent_id])
+
+
+def is_open(state):
+    """State.is_open of every offense agent"""
+    return evaluate_states([state], exact=False)[3][0].tolist()